@@ -1,32 +1,357 @@
 #!/home/arnaud/venv/bin/python3
 
+import os
+import sys
+import csv
+import json
 import argparse
 import tomllib
-from budget_report import read_from_config
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from budget_config import compile_config, ConfigError, layout_template
 
 WRITE_REFERENCE_FILES = True
+MANIFEST = '.br-manifest.json'
+RUN_REPORT = '.br-run.json'
+CENTIMES_METADATA = b'centimes'
+FORMATS = ['csv', 'parquet', 'arrow', 'feather']
+AMOUNTS = ['float', 'centimes']
+LABELS = ['category', 'arrow']
+JOB_DETAILS = ['header_mask', 'labels', 'move_labels', 'data',
+               'data_start_column', 'initial_chapter_name_column',
+               'chapter_number_mixed_with_name', 'rebuild_data',
+               'data_in_first_column', 'verbose', 'area', 'columns']
 
-parser = argparse.ArgumentParser(
-    prog='br',
-    description='Extract tables from budget report')
-parser.add_argument('-c', '--config', type=str, default='config.toml', help='configuration file')
-parser.add_argument('-o', '--output-dir', type=str, default='.', help='output directory')
-parser.add_argument('-r', '--only-read', help='just read the table, no processing', action='store_true')
+class Manifest:
+    def __init__(self, output_dir):
+        self.filename = os.path.join(output_dir, MANIFEST)
+        try:
+            with open(self.filename) as f:
+                self.tables = json.load(f)
+        except (OSError, ValueError):
+            self.tables = {}
 
-args = parser.parse_args()
-config_filename = args.config
-output_dir = args.output_dir
-only_read = args.only_read
+    def is_current(self, table, fingerprint, output):
+        entry = self.tables.get(table)
+        return (entry is not None and entry['fingerprint'] == fingerprint
+                and os.path.exists(output))
 
-with open(config_filename, 'rb') as f:
-    conf = tomllib.load(f)
-filename = conf['general']['filename']
+    def update(self, table, fingerprint, output):
+        directory = os.path.dirname(self.filename) or '.'
+        self.tables[table] = {'fingerprint': fingerprint,
+                              'output': os.path.relpath(output, directory)}
+        self.save()
 
-for table in conf['general']['tables']:
-    ct = conf[table]
-    c = read_from_config(filename, ct, only_read)
-    if WRITE_REFERENCE_FILES:
-        c.to_csv('/'.join([output_dir, table + '.csv']), float_format='%.2f')
+    def save(self):
+        write_json(self.filename, self.tables)
 
-print('-'*50, 'Done')
+class RunReport:
+    def __init__(self, output_dir):
+        self.filename = os.path.join(output_dir, RUN_REPORT)
+        try:
+            with open(self.filename) as f:
+                self.previous = json.load(f)
+        except (OSError, ValueError):
+            self.previous = None
+        self.run = None
 
+    def start(self, filename, tables, force, done):
+        self.run = {'filename': filename, 'tables': tables, 'force': force,
+                    'done': list(done), 'failed': []}
+        self.save()
+
+    def done(self, table):
+        self.run['done'].append(table)
+        self.save()
+
+    def fail(self, failure):
+        self.run['failed'].append(failure)
+        self.save()
+
+    def save(self):
+        if WRITE_REFERENCE_FILES:
+            write_json(self.filename, self.run)
+
+def write_json(filename, content):
+    from budget_report import file_mode
+
+    directory = os.path.dirname(filename) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+    os.chmod(tmp, file_mode())
+    os.replace(tmp, filename)
+
+def read_tables(filename, plans, only_read=False, jobs=1,
+                cache_dir=None, profile=None, dtypes=None, pool=None):
+    from budget_report import read_table, preload_plans, use_store, convert_table, TableReport, failure_record
+
+    def report(plan):
+        return None if profile is None else TableReport(plan.name, **profile)
+
+    if jobs == 1:
+        use_store(cache_dir)
+        try:
+            preload_plans(filename, plans)
+        except Exception as e:
+            print(f'Preload failed, reading the tables one by one: {type(e).__name__}: {e}')
+        for plan in plans:
+            table_report = report(plan)
+            try:
+                data = read_table(filename, plan, only_read, table_report,
+                                  dtypes)
+            except Exception as e:
+                yield plan.name, None, table_report, failure_record(plan.name, e)
+            else:
+                yield plan.name, data, table_report, None
+        return
+    if pool is None:
+        with table_pool(jobs) as pool:
+            yield from read_tables(filename, plans, only_read, jobs,
+                                   cache_dir, profile, dtypes, pool)
+        return
+    futures = {pool.submit(convert_table, filename, plan, only_read,
+                           report(plan), dtypes, cache_dir): plan.name
+               for plan in plans}
+    for future in as_completed(futures):
+        try:
+            table, data, table_report, output, failure = future.result()
+        except Exception as e:
+            yield futures[future], None, None, failure_record(futures[future], e)
+            continue
+        if output:
+            print('='*20, table)
+            print(output, end='')
+        yield table, data, table_report, failure
+
+def table_pool(jobs):
+    context = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(jobs, mp_context=context)
+
+def table_filename(output_dir, table, format='csv', dataset=None):
+    if dataset is not None:
+        return '/'.join([dataset, f'table={table}', 'part-0.parquet'])
+    return '/'.join([output_dir, table + '.' + format])
+
+def write_table(data, filename, format='csv'):
+    from budget_report import file_mode
+
+    if not WRITE_REFERENCE_FILES:
+        return
+    directory = os.path.dirname(filename) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        write_table_file(data, tmp, format)
+        os.chmod(tmp, file_mode())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def write_table_file(data, filename, format):
+    if format == 'csv':
+        from budget_report import format_centimes
+        format_centimes(data).to_csv(filename, float_format='%.2f')
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.feather as feather
+
+    table = arrow_table(data)
+    if format == 'parquet':
+        pq.write_table(table, filename)
+    elif format == 'feather':
+        feather.write_feather(table, filename)
+    else:
+        with pa.OSFile(filename, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+def arrow_table(data):
+    import pyarrow as pa
+    import pandas as pd
+
+    data = data.copy(deep=False)
+    centimes = data.attrs.get('centimes')
+    data.attrs = {}
+    if data.columns.has_duplicates:
+        data.columns = unique_names(data.columns)
+    for i, (name, cells) in enumerate(data.items()):
+        if pd.api.types.infer_dtype(cells, skipna=True).startswith('mixed'):
+            data.isetitem(i, cells.astype('string'))
+    table = pa.Table.from_pandas(data, preserve_index=True)
+    if centimes is None:
+        return table
+    names = [table.column_names[i] for i in centimes]
+    metadata = dict(table.schema.metadata or {})
+    metadata[CENTIMES_METADATA] = json.dumps(names).encode()
+    return table.replace_schema_metadata(metadata)
+
+def unique_names(names):
+    seen = set()
+    unique = []
+    for name in names:
+        name = str(name)
+        candidate, k = name, 0
+        while candidate in seen:
+            k += 1
+            candidate = f'{name}.{k}'
+        seen.add(candidate)
+        unique.append(candidate)
+    return unique
+
+def convert_report(filename, plan, output_dir, only_read=False, jobs=1,
+                   cache_dir=None, profile=None, force=False, format='csv',
+                   dataset=None, dtypes=None, resume=False, pool=None):
+    from budget_report import table_fingerprint, mark_stage, failure_record
+
+    manifest = Manifest(output_dir)
+    run = RunReport(output_dir)
+    if dataset is not None:
+        format = 'parquet'
+    fingerprints = {table.name: table_fingerprint(filename, table, only_read,
+                                                      dtypes)
+                    for table in plan.tables}
+    outputs = {table: table_filename(output_dir, table, format, dataset)
+               for table in fingerprints}
+    done = []
+    if resume and run.previous is not None:
+        force = run.previous['force']
+        done = run.previous['done']
+    elif resume:
+        print('No previous run to resume')
+
+    def is_current(table):
+        return manifest.is_current(table, fingerprints[table], outputs[table])
+
+    plans = [table for table in plan.tables
+             if not (table.name in done and is_current(table.name))
+             and (force or not is_current(table.name))]
+    tables = [table.name for table in plans]
+    skipped = [table for table in fingerprints if table not in tables]
+    if skipped:
+        print('Unchanged, skipped:', ' '.join(skipped))
+    run.start(filename, list(fingerprints), force, skipped)
+    converted = {}
+    failed = []
+    for table, data, report, failure in read_tables(filename, plans, only_read,
+                                                    jobs, cache_dir, profile,
+                                                    dtypes, pool):
+        if failure is None:
+            try:
+                write_table(data, outputs[table], format)
+            except Exception as e:
+                mark_stage(e, 'write_table', None)
+                failure = failure_record(table, e)
+        if failure is not None:
+            print(f"{table}: failed in {failure['stage']}, page {failure['page']}: {failure['error']}")
+            run.fail(failure)
+            failed.append(failure)
+            continue
+        if WRITE_REFERENCE_FILES:
+            manifest.update(table, fingerprints[table], outputs[table])
+        run.done(table)
+        converted[table] = report
+    return converted, failed
+
+def write_profile(reports, filename):
+    records = [record for report in reports if report is not None
+               for record in report.records]
+    if filename.endswith('.csv'):
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(records[0]) if records else [])
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(filename, 'w') as f:
+            json.dump(records, f, indent=2)
+
+def lean_dtypes_options(args):
+    if args.amounts is None and args.labels is None:
+        return None
+    return {'amounts': args.amounts, 'labels': args.labels}
+
+def print_plan(plan):
+    print('filename =', plan.filename)
+    for table in plan.tables:
+        print(f'[{table.name}] pages = {table.pages}, axis = {table.axis!r}')
+        for job in table.jobs:
+            details = [f'{key} = {getattr(job, key)!r}' for key in JOB_DETAILS
+                       if getattr(job, key)]
+            print(f'  p. {job.page}: table_number = {job.table_number}',
+                  f'header_lines = {job.header_lines}', *details, sep=', ')
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='br',
+        description='Extract tables from budget report')
+    parser.add_argument('-c', '--config', type=str, default='config.toml', help='configuration file')
+    parser.add_argument('-o', '--output-dir', type=str, default='.', help='output directory')
+    parser.add_argument('-r', '--only-read', help='just read the table, no processing', action='store_true')
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='output file format (default: csv)')
+    parser.add_argument('--dataset', type=str, default=None, help='write the tables into this Parquet dataset directory, partitioned by table')
+    parser.add_argument('--record-layout', type=str, default=None, metavar='FILE', help='detect the area and columns of each table and write them to this TOML template, no conversion')
+    parser.add_argument('--amounts', choices=AMOUNTS, default=None, help='store amounts as float64 or int64 centimes instead of nullable Float64')
+    parser.add_argument('--labels', choices=LABELS, default=None, help='store labels and index as category or pyarrow strings')
+    parser.add_argument('--check-config', help='validate the configuration and list the page jobs, no conversion', action='store_true')
+    parser.add_argument('-f', '--force', help='convert all tables, even unchanged ones', action='store_true')
+    parser.add_argument('--resume', help='continue the previous run, converting only the tables it did not complete', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of tables extracted in parallel (0: one per CPU)')
+    parser.add_argument('--cache-dir', type=str, default=None, help='raw extraction store (default: OUTPUT_DIR/.brcache)')
+    parser.add_argument('--no-cache', help='do not use the raw extraction store', action='store_true')
+    parser.add_argument('--profile', type=str, default=None, help='write per-stage timings to this JSON or CSV file')
+    parser.add_argument('--profile-memory', help='also record the peak memory of each stage (slower)', action='store_true')
+    parser.add_argument('--cprofile', action='append', default=[], metavar='STAGE', help='run STAGE under cProfile, can be repeated')
+
+    args = parser.parse_args()
+    config_filename = args.config
+    output_dir = args.output_dir
+    only_read = args.only_read
+    jobs = args.jobs or os.cpu_count()
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(output_dir, '.brcache')
+
+    profile = None
+    if args.profile or args.profile_memory or args.cprofile:
+        profile_dir = os.path.dirname(args.profile or '') or output_dir
+        profile = {'memory': args.profile_memory, 'cprofile': args.cprofile,
+                   'profile_dir': profile_dir}
+
+    with open(config_filename, 'rb') as f:
+        conf = tomllib.load(f)
+    try:
+        plan = compile_config(conf)
+    except ConfigError as e:
+        sys.exit(f'{config_filename}:\n{e}')
+    if args.check_config:
+        print_plan(plan)
+        return
+    filename = plan.filename
+    if args.record_layout:
+        from budget_report import detect_layouts
+        layouts = detect_layouts(filename, plan.tables)
+        with open(args.record_layout, 'w') as f:
+            f.write(layout_template(plan, layouts))
+        return
+
+    reports, failed = convert_report(filename, plan, output_dir, only_read,
+                                     jobs, cache_dir, profile, args.force,
+                                     args.format, args.dataset,
+                                     lean_dtypes_options(args), args.resume)
+    if args.profile:
+        write_profile(reports.values(), args.profile)
+
+    if failed:
+        print('-'*50, f'{len(failed)} failed:',
+              ' '.join(failure['table'] for failure in failed))
+        print(f'Details in {os.path.join(output_dir, RUN_REPORT)}, '
+              'rerun with --resume to convert only these tables')
+        return 1
+    print('-'*50, 'Done')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/home/arnaud/venv/bin/python3
+
+import os
+import sys
+import glob
+import time
+import argparse
+import tomllib
+import traceback
+from br import convert_report, lean_dtypes_options, table_pool, FORMATS, AMOUNTS, LABELS
+from budget_config import compile_config
+
+def load_manifest(filename):
+    with open(filename, 'rb') as f:
+        manifest = tomllib.load(f)
+    base = os.path.dirname(filename)
+    reports = []
+    for report in manifest['reports']:
+        config = os.path.join(base, report['config'])
+        pdf = report.get('filename')
+        if pdf is not None:
+            pdf = os.path.join(base, pdf)
+        reports.append((report.get('name', report_name(config)), config, pdf))
+    return reports
+
+def report_name(config):
+    directory, name = os.path.split(os.path.splitext(config)[0])
+    if name == 'config' and directory:
+        return os.path.basename(os.path.abspath(directory))
+    return name
+
+def find_reports(patterns):
+    reports = []
+    for pattern in patterns:
+        for config in sorted(glob.glob(pattern)):
+            reports.append((report_name(config), config, None))
+    return reports
+
+def duplicate_names(reports):
+    configs = {}
+    for name, config, pdf in reports:
+        configs.setdefault(name, []).append(config)
+    return {name: paths for name, paths in configs.items() if len(paths) > 1}
+
+def convert(name, config, pdf, output_dir, only_read, jobs, no_cache, force,
+            format='csv', dataset=None, dtypes=None, resume=False, pool=None):
+    from budget_report import page_cache
+
+    with open(config, 'rb') as f:
+        plan = compile_config(tomllib.load(f))
+    if pdf is None:
+        pdf = os.path.join(os.path.dirname(config), plan.filename)
+    report_dir = os.path.join(output_dir, name)
+    os.makedirs(report_dir, exist_ok=True)
+    cache_dir = None if no_cache else os.path.join(report_dir, '.brcache')
+    if dataset is not None:
+        dataset = os.path.join(dataset, f'report={name}')
+    try:
+        tables, failed = convert_report(pdf, plan, report_dir, only_read, jobs,
+                                        cache_dir, force=force, format=format,
+                                        dataset=dataset, dtypes=dtypes,
+                                        resume=resume, pool=pool)
+        return tables, failed, len(plan.tables) - len(tables) - len(failed)
+    finally:
+        page_cache.clear()
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='brbatch',
+        description='Extract tables from many budget reports')
+    parser.add_argument('configs', nargs='*', help='configuration files or glob patterns')
+    parser.add_argument('-m', '--manifest', type=str, default=None, help='TOML file listing the reports')
+    parser.add_argument('-o', '--output-dir', type=str, default='.', help='output directory, one subdirectory per report')
+    parser.add_argument('-r', '--only-read', help='just read the table, no processing', action='store_true')
+    parser.add_argument('-f', '--force', help='convert all tables, even unchanged ones', action='store_true')
+    parser.add_argument('--resume', help='continue the previous run of each report, converting only the tables it did not complete', action='store_true')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of tables extracted in parallel (0: one per CPU)')
+    parser.add_argument('--format', choices=FORMATS, default='csv', help='output file format (default: csv)')
+    parser.add_argument('--dataset', type=str, default=None, help='write all tables into this Parquet dataset directory, partitioned by report and table')
+    parser.add_argument('--amounts', choices=AMOUNTS, default=None, help='store amounts as float64 or int64 centimes instead of nullable Float64')
+    parser.add_argument('--labels', choices=LABELS, default=None, help='store labels and index as category or pyarrow strings')
+    parser.add_argument('--no-cache', help='do not use the raw extraction store', action='store_true')
+
+    args = parser.parse_args()
+    reports = find_reports(args.configs)
+    if args.manifest:
+        reports.extend(load_manifest(args.manifest))
+    if not reports:
+        parser.error('no report to convert')
+    duplicates = duplicate_names(reports)
+    if duplicates:
+        parser.error('several reports would share an output directory, '
+                     'name them in a manifest: ' + '; '.join(
+                         f"{name}: {' '.join(paths)}"
+                         for name, paths in duplicates.items()))
+    jobs = args.jobs or os.cpu_count()
+    # One pool for all the reports, so that the workers keep their JVM
+    pool = table_pool(jobs) if jobs > 1 else None
+
+    summary = []
+    try:
+        for name, config, pdf in reports:
+            print('#'*20, name)
+            start = time.perf_counter()
+            try:
+                tables, failed, skipped = convert(
+                    name, config, pdf, args.output_dir, args.only_read, jobs,
+                    args.no_cache, args.force, args.format, args.dataset,
+                    lean_dtypes_options(args), args.resume, pool)
+                status = f'{len(tables)} converted, {skipped} skipped'
+                if failed:
+                    status = (f'FAILED {len(failed)} tables '
+                              f"({' '.join(f['table'] for f in failed)}), {status}")
+            except Exception as e:
+                traceback.print_exc()
+                status = f'FAILED {type(e).__name__}: {e}'
+            summary.append((name, time.perf_counter() - start, status))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    print('-'*50, 'Summary')
+    width = max(len(name) for name, _, _ in summary)
+    for name, elapsed, status in summary:
+        print(f'{name:{width}} {elapsed:8.1f}s  {status}')
+    failed = sum(status.startswith('FAILED') for _, _, status in summary)
+    print('-'*50, f'{len(summary) - failed} done, {failed} failed')
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+#!/home/arnaud/venv/bin/python3
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import pandas as pd
+import tabula
+from budget_report import read_from_config, page_cache, TableReport
+
+PAGE_WIDTH = 842
+PAGE_HEIGHT = 595
+FONT_SIZE = 8
+LINE_HEIGHT = 11
+TOP = 540
+BOTTOM = 40
+# Helvetica advance widths, in 1/1000 of the font size
+CHAR_WIDTHS = {' ': 278, ',': 278, '.': 278, '-': 333}
+DIGIT_WIDTH = 556
+DEFAULT_WIDTH = 556
+
+WORDS = ['charges', 'caractère', 'général', 'personnel', 'frais',
+         'assimilés', 'atténuations', 'produits', 'autres', 'gestion',
+         'courante', 'financières', 'exceptionnelles', 'dotations',
+         'amortissements', 'provisions', 'subventions', 'investissement',
+         'équipement', 'immobilisations', 'corporelles', 'incorporelles',
+         'emprunts', 'dettes', 'opérations', 'ordre', 'sections',
+         'participations', 'créances', 'reprises']
+
+SCENARIOS = ['simple', 'multiline', 'multipage', 'mixed_chapters',
+             'data_in_first_column']
+
+def text_width(s):
+    width = 0
+    for c in s:
+        if c.isdigit():
+            width += DIGIT_WIDTH
+        else:
+            width += CHAR_WIDTHS.get(c, DEFAULT_WIDTH)
+    return width * FONT_SIZE / 1000
+
+def amount(value):
+    return f'{value:,.2f}'.replace(',', ' ').replace('.', ',')
+
+def pdf_string(s):
+    s = s.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    return s.encode('cp1252', errors='replace')
+
+def page_stream(cells):
+    lines = [b'BT', b'/F1 %d Tf' % FONT_SIZE]
+    for x, y, s in cells:
+        lines.append(b'1 0 0 1 %.2f %.2f Tm (' % (x, y) + pdf_string(s) + b') Tj')
+    lines.append(b'ET')
+    return b'\n'.join(lines)
+
+def write_pdf(filename, pages):
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica '
+               b'/Encoding /WinAnsiEncoding >>']
+    kids = []
+    for cells in pages:
+        stream = page_stream(cells)
+        objects.append(b'<< /Length %d >>\nstream\n' % len(stream)
+                       + stream + b'\nendstream')
+        contents = len(objects)
+        objects.append(b'<< /Type /Page /Parent 2 0 R '
+                       b'/MediaBox [0 0 %d %d] ' % (PAGE_WIDTH, PAGE_HEIGHT)
+                       + b'/Resources << /Font << /F1 3 0 R >> >> '
+                       b'/Contents %d 0 R >>' % contents)
+        kids.append(b'%d 0 R' % len(objects))
+    objects[1] = (b'<< /Type /Pages /Kids [' + b' '.join(kids)
+                  + b'] /Count %d >>' % len(kids))
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n' % number + obj + b'\nendobj\n'
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    for offset in offsets:
+        out += b'%010d 00000 n \n' % offset
+    out += (b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+            % (len(objects) + 1, xref))
+    with open(filename, 'wb') as f:
+        f.write(out)
+
+class SyntheticTable:
+    def __init__(self, scenario, rows, pages, multiline, seed=0):
+        self.scenario = scenario
+        self.pages = pages if scenario == 'multipage' else 1
+        self.rows = rows * self.pages
+        if scenario in ['simple', 'data_in_first_column']:
+            multiline = 0
+        self.multiline = multiline
+        self.random = random.Random(seed)
+
+    def label(self):
+        words = self.random.sample(WORDS, self.random.randint(2, 5))
+        return ' '.join(words).capitalize()
+
+    def amounts(self, count):
+        return [amount(self.random.randint(0, 10**9) / 100)
+                for _ in range(count)]
+
+    def layout(self):
+        if self.scenario == 'mixed_chapters':
+            return [40], [460, 580, 700]
+        if self.scenario == 'data_in_first_column':
+            return [40], [580, 700]
+        return [40, 80], [460, 580, 700]
+
+    def header(self):
+        if self.scenario == 'mixed_chapters':
+            return [['Chapitre', 'Budget', 'Propositions', 'Vote'],
+                    ['Libellé', 'précédent', 'nouvelles', '']]
+        if self.scenario == 'data_in_first_column':
+            return [['Libellé', 'Propositions', 'Vote'],
+                    ['', 'nouvelles', '']]
+        return [['Chap.', 'Libellé', 'Budget', 'Propositions', 'Vote'],
+                ['', '', 'précédent', 'nouvelles', '']]
+
+    def rows_groups(self):
+        for i in range(self.rows):
+            chapter = str(10 + i)
+            label = self.label()
+            if self.scenario == 'mixed_chapters':
+                group = [[f'{chapter} {label}'] + self.amounts(3)]
+            elif self.scenario == 'data_in_first_column':
+                values = self.amounts(3)
+                group = [[f'{label} {values[0]}'] + values[1:]]
+            else:
+                group = [[chapter, label] + self.amounts(3)]
+            if self.random.random() < self.multiline:
+                continuation = [''] * (len(self.layout()[0]) - 1)
+                group.append(continuation + [self.label().lower()])
+            yield group
+
+    def paginate(self):
+        groups = list(self.rows_groups())
+        capacity = (TOP - BOTTOM) // LINE_HEIGHT - len(self.header())
+        lines = sum(len(group) for group in groups)
+        per_page = min(capacity, -(-lines // self.pages))
+        page = []
+        for group in groups:
+            if page and len(page) + len(group) > per_page:
+                yield page
+                page = []
+            page.extend(group)
+        if page:
+            yield page
+
+    def render(self, filename):
+        left, right = self.layout()
+        pages = []
+        for lines in self.paginate():
+            cells = []
+            y = TOP
+            for row in self.header() + lines:
+                for x, s in zip(left, row):
+                    if s:
+                        cells.append((x, y, s))
+                for x, s in zip(right, row[len(left):]):
+                    if s:
+                        cells.append((x - text_width(s), y, s))
+                y -= LINE_HEIGHT
+            pages.append(cells)
+        write_pdf(filename, pages)
+        return len(pages)
+
+    def config(self, pages):
+        config = {'header_lines': 2, 'table_number': 0}
+        if pages == 1:
+            config['pages'] = 1
+        else:
+            config['pages'] = list(range(1, pages + 1))
+        if self.scenario == 'mixed_chapters':
+            config['chapter_number_mixed_with_name'] = True
+            config['data_start_column'] = 1
+        if self.scenario == 'data_in_first_column':
+            config['data_in_first_column'] = ['Budget Précédent']
+            config['data_start_column'] = 1
+        return config
+
+def run_scenario(filename, config, repeat):
+    runs = []
+    for _ in range(repeat):
+        page_cache.clear()
+        report = TableReport()
+        start = time.perf_counter()
+        data = read_from_config(filename, dict(config), report=report)
+        total = time.perf_counter() - start
+        timings = report.seconds()
+        timings['other'] = total - sum(timings.values())
+        timings['total'] = total
+        runs.append(timings)
+    best = {name: min(run.get(name, 0) for run in runs) for name in runs[0]}
+    return {'output_shape': list(data.shape), 'best': best, 'runs': runs}
+
+def code_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(args, scenarios, workdir):
+    results = {'version': code_version(),
+               'python': platform.python_version(),
+               'pandas': pd.__version__,
+               'tabula': tabula.__version__,
+               'parameters': {'rows': args.rows, 'pages': args.pages,
+                              'multiline': args.multiline,
+                              'repeat': args.repeat, 'seed': args.seed},
+               'scenarios': {}}
+    for scenario in scenarios:
+        table = SyntheticTable(scenario, args.rows, args.pages,
+                               args.multiline, args.seed)
+        filename = os.path.join(workdir, scenario + '.pdf')
+        pages = table.render(filename)
+        if 'jvm_startup' not in results:
+            start = time.perf_counter()
+            page_cache.read(filename, 1)
+            results['jvm_startup'] = time.perf_counter() - start
+        result = run_scenario(filename, table.config(pages), args.repeat)
+        result['pages'] = pages
+        results['scenarios'][scenario] = result
+        print(f'{scenario:22} {result["best"]["total"]:8.3f}s',
+              file=sys.stderr)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='brbench',
+        description='Time the extraction stages on synthetic budget reports')
+    parser.add_argument('-s', '--scenario', action='append', choices=SCENARIOS, help='scenario to run, can be repeated (default: all)')
+    parser.add_argument('--rows', type=int, default=30, help='number of table rows per page')
+    parser.add_argument('--pages', type=int, default=4, help='number of pages of the multipage scenario')
+    parser.add_argument('--multiline', type=float, default=0.2, help='ratio of labels spanning two lines')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per scenario')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the generated tables')
+    parser.add_argument('--workdir', type=str, default=None, help='keep the generated PDF files in this directory')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON result file (default: stdout)')
+
+    args = parser.parse_args()
+    scenarios = args.scenario or SCENARIOS
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        results = run_benchmarks(args, scenarios, args.workdir)
+    else:
+        with tempfile.TemporaryDirectory(prefix='brbench-') as workdir:
+            results = run_benchmarks(args, scenarios, workdir)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
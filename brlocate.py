@@ -0,0 +1,153 @@
+#!/home/arnaud/venv/bin/python3
+
+import re
+import sys
+import copy
+import difflib
+import argparse
+import tomllib
+import statistics
+from budget_config import compile_config, ConfigError, format_config
+from budget_report import page_cache, use_store, read_options, header_signature
+
+MIN_SCORE = 0.6
+HEADER_WEIGHT = 0.8
+SHIFT_PENALTY = 0.002
+WORD = re.compile(r'[^\W\d_]{3,}')
+
+def page_words(tables):
+    words = set()
+    for df in tables:
+        for cell in df.to_numpy().ravel():
+            if isinstance(cell, str):
+                words.update(w.lower() for w in WORD.findall(cell))
+    return words
+
+def similarity(a, b):
+    return difflib.SequenceMatcher(None, ' | '.join(a), ' | '.join(b)).ratio()
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b) if a | b else 0
+
+def first_jobs(layout):
+    if isinstance(layout, int):
+        return {layout}
+    first = set()
+    for i, job in enumerate(layout):
+        if isinstance(job, tuple):
+            first |= first_jobs(job)
+        elif i == 0:
+            first.add(job)
+    return first
+
+def replace_pages(pages, new_pages):
+    if isinstance(pages, int):
+        return next(new_pages)
+    return [replace_pages(page, new_pages) for page in pages]
+
+class Locator:
+    def __init__(self, old_filename, new_filename):
+        self.old_filename = old_filename
+        self.pages = page_cache.read_all(new_filename)
+        if not self.pages:
+            raise ValueError(f'no table found in {new_filename}')
+        self.words = {page: page_words(tables)
+                      for page, tables in self.pages.items()}
+        self.old_words = {}
+
+    def old_table(self, job):
+        options = read_options(job)
+        tables = page_cache.read(self.old_filename, job.page, **options)
+        if job.page not in self.old_words:
+            self.old_words[job.page] = page_words(
+                page_cache.read(self.old_filename, job.page))
+        return tables[0 if options else job.table_number]
+
+    def candidates(self, job):
+        signature = header_signature(self.old_table(job), job.header_lines)
+        words = self.old_words[job.page]
+        for page, tables in self.pages.items():
+            context = jaccard(words, self.words[page])
+            for k, table in enumerate(tables):
+                header = header_signature(table, job.header_lines)
+                score = (HEADER_WEIGHT * similarity(signature, header)
+                         + (1 - HEADER_WEIGHT) * context)
+                yield score, page, k
+
+    def locate(self, plans):
+        candidates = {(plan.name, i): list(self.candidates(job))
+                      for plan in plans for i, job in enumerate(plan.jobs)}
+        shifts = []
+        for plan in plans:
+            for i, job in enumerate(plan.jobs):
+                score, page, k = max(candidates[plan.name, i])
+                if score >= MIN_SCORE:
+                    shifts.append(page - job.page)
+        shift = min(statistics.multimode(shifts), key=abs) if shifts else 0
+        matches = {}
+        for plan in plans:
+            for i, job in enumerate(plan.jobs):
+                expected = job.page + shift
+                matches[plan.name, i] = max(
+                    candidates[plan.name, i],
+                    key=lambda c: c[0] - SHIFT_PENALTY * abs(c[1] - expected))
+        return matches
+
+def relocate_section(section, plan, matches):
+    section = copy.deepcopy(section)
+    new_pages = [matches[plan.name, i][1] for i in range(len(plan.jobs))]
+    section['pages'] = replace_pages(section['pages'], iter(new_pages))
+    overrides = {key: section.pop(key) for key in list(section)
+                 if key.isdigit() and isinstance(section[key], dict)}
+    first = first_jobs(plan.layout)
+    table_number = matches[plan.name, 0][2]
+    if any(not job.area and not job.columns for job in plan.jobs):
+        section['table_number'] = table_number
+    for i, job in enumerate(plan.jobs):
+        page = str(new_pages[i])
+        override = dict(overrides.get(str(job.page), {}))
+        k = matches[plan.name, i][2]
+        default = table_number if i in first else 0
+        if not job.area and not job.columns and (k != default
+                                                 or 'table_number' in override):
+            override['table_number'] = k
+        if override:
+            section[page] = override
+    return section
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='brlocate',
+        description="Find the tables of a configuration in a new budget report")
+    parser.add_argument('filename', help='new PDF report')
+    parser.add_argument('-c', '--config', type=str, default='config.toml', help='configuration of a previous report')
+    parser.add_argument('-o', '--output', type=str, default=None, help='write the updated configuration to this file')
+    parser.add_argument('--cache-dir', type=str, default='.brcache', help='raw extraction store (default: .brcache)')
+    parser.add_argument('--no-cache', help='do not use the raw extraction store', action='store_true')
+
+    args = parser.parse_args()
+    with open(args.config, 'rb') as f:
+        conf = tomllib.load(f)
+    try:
+        plan = compile_config(conf)
+    except ConfigError as e:
+        sys.exit(f'{args.config}:\n{e}')
+    use_store(None if args.no_cache else args.cache_dir)
+
+    locator = Locator(plan.filename, args.filename)
+    matches = locator.locate(plan.tables)
+    conf['general']['filename'] = args.filename
+    for table in plan.tables:
+        old = ' '.join(str(job.page) for job in table.jobs)
+        new = ' '.join(f'{matches[table.name, i][1]}/{matches[table.name, i][2]}'
+                       for i in range(len(table.jobs)))
+        score = min(matches[table.name, i][0] for i in range(len(table.jobs)))
+        flag = '' if score >= MIN_SCORE else '  to check'
+        print(f'{table.name:10} {old:>12} -> {new:16} {score:.2f}{flag}')
+        conf[table.name] = relocate_section(conf[table.name], table, matches)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(format_config(conf))
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,92 @@
 #!/home/arnaud/venv/bin/python3
 
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
 import numpy as np
 import pandas as pd
 import unittest
 import tomllib
-from budget_report import read_from_config
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from budget_report import read_from_config, parse_numbers, lean_dtypes, format_centimes, SinglePageTable
+from budget_report import page_cache, use_store, file_mode, PageCache, PageStore, MissingPageError
+from budget_config import compile_config, compile_table, ConfigError
+from merge_function_tables import merge_dataframes
+from brlocate import relocate_section, Locator
+from br import convert_report, arrow_table, RUN_REPORT, CENTIMES_METADATA
+from brbatch import duplicate_names
 
 with open('config.toml', 'rb') as f:
     conf = tomllib.load(f)
 filename = conf['general']['filename']
 
+FIXTURES = 'fixtures'
+FIXTURE_INDEX = 'fixtures.json'
+MODES = ['replay', 'record', 'live']
+
+def fixtures_dir():
+    return os.environ.get('BRTEST_FIXTURES', FIXTURES)
+
+def load_fixture_index():
+    try:
+        with open(os.path.join(fixtures_dir(), FIXTURE_INDEX)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_fixture_index(index):
+    directory = fixtures_dir()
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.chmod(tmp, file_mode())
+    os.replace(tmp, os.path.join(directory, FIXTURE_INDEX))
+
+def fixture_mode():
+    mode = os.environ.get('BRTEST_MODE')
+    if mode is None:
+        return 'replay' if filename in load_fixture_index() else 'live'
+    if mode not in MODES:
+        raise ValueError(f'BRTEST_MODE shall be one of {MODES}')
+    return mode
+
 class test_bg(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        mode = fixture_mode()
+        if mode == 'replay':
+            digest = load_fixture_index().get(filename)
+            if digest is None:
+                raise unittest.SkipTest(f'no fixtures for {filename}, run brtest.py --record')
+            page_cache.register(filename, digest)
+            page_cache.offline = True
+            use_store(fixtures_dir())
+            return
+        if not os.path.isfile(filename):
+            raise unittest.SkipTest(f'{filename} not found')
+        if mode == 'record':
+            use_store(fixtures_dir())
+            index = load_fixture_index()
+            index[filename] = page_cache.digest(filename)
+            save_fixture_index(index)
+        else:
+            use_store(None)
+
+    @classmethod
+    def tearDownClass(cls):
+        page_cache.offline = False
+        page_cache.registered.clear()
+        page_cache.clear()
+        use_store(None)
+
     def setUp(self):
         with open('config.toml', 'rb') as f:
             config = tomllib.load(f)
@@ -87,5 +162,341 @@ class test_bg(unittest.TestCase):
     def test_data_in_first_columns(self):
         self._test_table('f7i')
 
+class test_numbers(unittest.TestCase):
+
+    def test_parse_numbers(self):
+        cells = pd.Series(['1 234,56', '1\u00a0234,56', '12\u202f345,00',
+                           '-3,5', '', 'Total', np.nan])
+        expected = pd.Series([1234.56, 1234.56, 12345.0, -3.5, np.nan,
+                              'Total', np.nan], dtype=object)
+        pd.testing.assert_series_equal(parse_numbers(cells), expected)
+
+    def test_lean_dtypes(self):
+        data = pd.DataFrame({'Libellé': ['a', 'b', 'c'],
+                             'Vote': [1234.56, -0.5, np.nan],
+                             'Taux': [0.125, 1.0, 2.0]},
+                            index=['10', '11', '12']).convert_dtypes(convert_integer=False)
+        lean = lean_dtypes(data, amounts='centimes', labels='category')
+        self.assertEqual(lean.attrs['centimes'], [1])
+        self.assertEqual(str(lean['Vote'].dtype), 'Int64')
+        self.assertEqual(list(lean['Vote'][:2]), [123456, -50])
+        self.assertEqual(str(lean['Taux'].dtype), 'float64')
+        self.assertEqual(str(lean['Libellé'].dtype), 'category')
+        self.assertEqual(format_centimes(lean).to_csv(float_format='%.2f'),
+                         data.to_csv(float_format='%.2f'))
+        self.assertNotIn('centimes', lean_dtypes(data, amounts='float').attrs)
+        data = pd.DataFrame([[1.25, 0.125, 'a'], [2.5, 1.333, 'b']],
+                            columns=['Vote', 'Vote', 'Vote'])
+        lean = lean_dtypes(data, amounts='centimes')
+        self.assertEqual(lean.attrs['centimes'], [0])
+        self.assertEqual(format_centimes(lean).to_csv(float_format='%.2f'),
+                         data.to_csv(float_format='%.2f'))
+
+class test_fixtures(unittest.TestCase):
+
+    def test_replay(self):
+        raw = pd.DataFrame([['Chapitre', 'Libellé'], ['011', 'Charges']])
+        with tempfile.TemporaryDirectory() as directory:
+            cache = PageCache(PageStore(directory))
+            cache.register('absent.pdf', 'digest')
+            cache.add('absent.pdf', 3, {'stream': True}, [raw])
+            replay = PageCache(PageStore(directory))
+            replay.register('absent.pdf', 'digest')
+            replay.offline = True
+            pd.testing.assert_frame_equal(replay.read('absent.pdf', 3)[0], raw)
+            with self.assertRaises(MissingPageError):
+                replay.read('absent.pdf', 4)
+            with self.assertRaises(MissingPageError):
+                replay.preload('absent.pdf', [3, 4])
+
+class test_output(unittest.TestCase):
+
+    def test_arrow_duplicate_columns(self):
+        data = pd.DataFrame([['a', 'b', 'c', 'd']], columns=[0, 1, 2, 1])
+        table = arrow_table(data)
+        self.assertEqual(table.column_names[:4], ['0', '1', '2', '1.1'])
+        data = pd.DataFrame([[1.0, 2.0, 3.0]], columns=['Vote', 'Vote', 'Vote.1'])
+        self.assertEqual(arrow_table(data).column_names[:3],
+                         ['Vote', 'Vote.1', 'Vote.1.1'])
+
+    def test_arrow_centimes_metadata(self):
+        data = pd.DataFrame({'Vote': [1234.56, np.nan], 'Taux': [0.125, 1.0]},
+                            index=['10', '11']).convert_dtypes(convert_integer=False)
+        table = arrow_table(lean_dtypes(data, amounts='centimes'))
+        self.assertEqual(json.loads(table.schema.metadata[CENTIMES_METADATA]), ['Vote'])
+        self.assertEqual(table.column('Vote').to_pylist(), [123456, None])
+        self.assertNotIn(CENTIMES_METADATA, arrow_table(data).schema.metadata)
+        table = arrow_table(lean_dtypes(data, amounts='float'))
+        self.assertNotIn(CENTIMES_METADATA, table.schema.metadata)
+        data = pd.DataFrame([[1.0, 0.125]], columns=['Vote', 'Vote'])
+        table = arrow_table(lean_dtypes(data, amounts='centimes'))
+        self.assertEqual(json.loads(table.schema.metadata[CENTIMES_METADATA]), ['Vote'])
+        self.assertEqual(table.column_names[:2], ['Vote', 'Vote.1'])
+
+class test_batch(unittest.TestCase):
+
+    def test_duplicate_names(self):
+        reports = [('rep', 'x/rep.toml', None), ('rep', 'y/rep.toml', None),
+                   ('ville', 'ville/config.toml', None)]
+        self.assertEqual(duplicate_names(reports),
+                         {'rep': ['x/rep.toml', 'y/rep.toml']})
+
+class test_resume(unittest.TestCase):
+
+    def tearDown(self):
+        page_cache.offline = False
+        page_cache.registered.clear()
+        page_cache.clear()
+        use_store(None)
+
+    def test_failed_table_is_resumed(self):
+        raw = pd.DataFrame([['Chapitre', 'Libellé', 'Vote'],
+                            ['A', 'Charges', '1,00']])
+        plan = compile_config({'general': {'filename': 'absent.pdf',
+                                           'tables': ['a', 'b']},
+                               'a': {'pages': 3, 'table_number': 0},
+                               'b': {'pages': 4, 'table_number': 0}})
+        with tempfile.TemporaryDirectory() as directory:
+            store = os.path.join(directory, '.brcache')
+            page_cache.register('absent.pdf', 'digest')
+            page_cache.offline = True
+            use_store(store)
+            page_cache.add('absent.pdf', 3, {'stream': True}, [raw])
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                converted, failed = convert_report('absent.pdf', plan, directory,
+                                                   cache_dir=store, force=True)
+            self.assertIn('b: failed in read_data, page 4', output.getvalue())
+            self.assertEqual(list(converted), ['a'])
+            self.assertEqual([(f['table'], f['stage'], f['page']) for f in failed],
+                             [('b', 'read_data', 4)])
+            with open(os.path.join(directory, RUN_REPORT)) as f:
+                run = json.load(f)
+            self.assertEqual(run['done'], ['a'])
+            self.assertIn('MissingPageError', run['failed'][0]['traceback'])
+            page_cache.add('absent.pdf', 4, {'stream': True}, [raw])
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                converted, failed = convert_report('absent.pdf', plan, directory,
+                                                   cache_dir=store, resume=True)
+            self.assertIn('Unchanged, skipped: a', output.getvalue())
+            self.assertEqual((list(converted), failed), (['b'], []))
+            self.assertTrue(os.path.isfile(os.path.join(directory, 'b.csv')))
+
+class test_chapters(unittest.TestCase):
+
+    def table(self, data):
+        table = SinglePageTable.__new__(SinglePageTable)
+        table.data = data
+        table.data_start_column = 2
+        table.verbose = False
+        table.report = None
+        table.pages = 1
+        return table
+
+    def merged(self, rows):
+        table = self.table(pd.DataFrame(rows, dtype=object))
+        table.merge_multilines_cells()
+        return table.data.values.tolist()
+
+    def test_merge_continuation_first_row(self):
+        # Merging the first row used to blank the last row, which is dropped too
+        self.assertEqual(self.merged([['', 'suite', np.nan],
+                                      ['10', 'Charges', '1,00'],
+                                      ['11', 'Autres', '2,00']]),
+                         [['10', 'Charges', '1,00']])
+
+    def test_merge_two_continuation_rows(self):
+        # The second continuation row is merged into the first one, then dropped
+        self.assertEqual(self.merged([['10', 'Charges', '1,00'],
+                                      [np.nan, 'à caractère', np.nan],
+                                      [np.nan, 'général', ''],
+                                      ['11', 'Autres', '2,00']]),
+                         [['10', 'Charges à caractère', '1,00'],
+                          ['11', 'Autres', '2,00']])
+
+    def test_merge_nan_and_float_labels(self):
+        self.assertEqual(self.merged([[10.0, 'Charges', '1,00'],
+                                      [np.nan, 'suite', np.nan],
+                                      [11.0, np.nan, '2,00'],
+                                      [2.5, 'x', np.nan]]),
+                         [['10', 'Charges suite', '1,00'],
+                          ['11 2', 'x', '2,00']])
+
+    def test_merge_truncated_numbers(self):
+        self.assertEqual(self.merged([['10', 'Charges', '1 234'],
+                                      [np.nan, 'suite', ',56'],
+                                      ['11', 'Autres', '2,00']]),
+                         [['10', 'Charges suite', '1 234,56'],
+                          ['11', 'Autres', '2,00']])
+
+    def test_rebuild_line_data(self):
+        table = self.table(pd.DataFrame([['10', 'a', '1 234,56 2,00', np.nan],
+                                         ['11', 'b', '5,00', np.nan],
+                                         ['12', 'c', 'x', 'y']], dtype=object))
+        table.rebuild_line_data()
+        self.assertEqual(table.data.values.tolist(),
+                         [['10', 'a', '1 234,56', '2,00'],
+                          ['11', 'b', '5,00', '5,00'],
+                          ['12', 'c', 'x', 'y']])
+
+    def test_extract_data_from_first_column(self):
+        table = self.table(pd.DataFrame([['011 Charges 1 234,56 12,00', 'a'],
+                                         ['012 Personnel (4) 5,00 0,00', 'b']],
+                                        columns=['Chapitre', 'X']))
+        table.data_in_first_column = ['Vote', 'Réalisé']
+        table.extract_data_from_first_column()
+        self.assertEqual(list(table.data.columns), ['Chapitre', 'Vote', 'Réalisé', 'X'])
+        self.assertEqual(table.data.values.tolist(),
+                         [['011 Charges', '1 234,56', '12,00', 'a'],
+                          ['012 Personnel (4)', '5,00', '0,00', 'b']])
+
+    def test_extract_chapter_numbers(self):
+        table = self.table(pd.DataFrame({0: ['011 Charges (4)', 'Total', np.nan],
+                                         1: ['1,00', '2,00', '3,00']}))
+        table.extract_chapter_numbers()
+        self.assertEqual(table.data['Chapitre'][0], '011')
+        self.assertTrue(pd.isna(table.data['Chapitre'][1]))
+        self.assertEqual(list(table.data['Libellé'][:2]), ['Charges', 'Total'])
+
+    def test_convert_first_col_to_index(self):
+        table = self.table(pd.DataFrame({'Chapitre': ['011', '', np.nan, 12.0],
+                                         'Libellé': ['a', 'Total', 'b', 'c'],
+                                         'Vote': ['1,00', '2,00', '3,00', '4,00']}))
+        table.convert_first_col_to_index()
+        self.assertEqual(list(table.data.index), ['011', 'Total', 'b', '12'])
+        self.assertEqual(list(table.data['Libellé']), ['a', '', '', 'c'])
+        self.assertEqual(table.data_start_column, 1)
+
+class test_config(unittest.TestCase):
+
+    def test_compile_config(self):
+        plan = compile_config(conf)
+        self.assertEqual([t.name for t in plan.tables], conf['general']['tables'])
+
+    def test_page_overrides(self):
+        plan = compile_table('t', {'pages': [3, [4, 5]], 'table_number': 2,
+                                   'header_lines': 2,
+                                   '5': {'table_number': 1, 'header_lines': 3}})
+        self.assertEqual(plan.layout, (0, (1, 2)))
+        self.assertEqual([j.table_number for j in plan.jobs], [2, 2, 1])
+        self.assertEqual([j.header_lines for j in plan.jobs], [2, 2, 3])
+        self.assertEqual(plan.jobs[0].labels, ((0, 'Chapitre'),))
+
+    def test_invalid_config(self):
+        for ct in [{'table_number': 1},
+                   {'pages': 3, 'header_lines': 1, 'header_mask': [[[1, 0], [1, 2]]]},
+                   {'pages': 3, 'header_mask': [[[0, 2], [0, 1]]]},
+                   {'pages': 3, 'tabel_number': 1},
+                   {'pages': 3, '4': {'table_number': 1}},
+                   {'pages': 3, 'area': [100, 20, 50, 500]},
+                   {'pages': 3, 'columns': [80, 60]}]:
+            with self.assertRaises(ConfigError):
+                compile_table('t', ct)
+
+class test_locate(unittest.TestCase):
+
+    def test_relocate_section(self):
+        section = {'pages': [31, [32, 33]], 'table_number': 1,
+                   '32': {'labels': {'1': 'nan'}}}
+        plan = compile_table('t', section)
+        matches = {('t', 0): (1, 35, 2), ('t', 1): (1, 36, 0),
+                   ('t', 2): (1, 37, 1)}
+        self.assertEqual(relocate_section(section, plan, matches),
+                         {'pages': [35, [36, 37]], 'table_number': 2,
+                          '36': {'labels': {'1': 'nan'}, 'table_number': 0},
+                          '37': {'table_number': 1}})
+
+    def test_most_common_shift(self):
+        shifts = {10: 1, 20: 1, 30: 5, 40: 6, 50: 7}
+        plans = [compile_table(f't{page}', {'pages': page}) for page in shifts]
+        plans.append(compile_table('t60', {'pages': 60}))
+
+        def candidates(job):
+            if job.page in shifts:
+                return [(0.9, job.page + shifts[job.page], 0)]
+            return [(0.3, 61, 0), (0.3, 65, 0)]
+
+        locator = Locator.__new__(Locator)
+        locator.candidates = candidates
+        matches = locator.locate(plans)
+        self.assertEqual(matches['t60', 0], (0.3, 61, 0))
+
+class test_merge(unittest.TestCase):
+
+    def test_merge_dataframes(self):
+        df1 = pd.DataFrame({'Libellé': ['a', 'b'], 'Vote': [1.0, 2.0]},
+                           index=['10', '11']).convert_dtypes()
+        df2 = pd.DataFrame({'Libellé': ['c', 'd'], 'Budget': [3.0, 4.0]},
+                           index=['12', '10']).convert_dtypes()
+        merged = merge_dataframes([df1, df2])
+        self.assertEqual(list(merged.index), ['10', '11', '12'])
+        self.assertEqual(list(merged.columns), ['Libellé', 'Vote', 'Budget'])
+        self.assertEqual(list(merged['Libellé']), ['d', 'b', 'c'])
+        self.assertEqual(merged.loc['10', 'Vote'], 1.0)
+        self.assertTrue(np.isnan(merged.loc['11', 'Budget']))
+
+def suite_ids(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from suite_ids(test)
+        else:
+            yield test.id().split('.', 1)[1]
+
+def run_tests(names, verbosity=1):
+    stream = io.StringIO()
+    suite = unittest.defaultTestLoader.loadTestsFromNames(names, sys.modules[__name__])
+    result = unittest.TextTestRunner(stream=stream, verbosity=verbosity).run(suite)
+    return (stream.getvalue(), result.testsRun,
+            len(result.failures) + len(result.errors), len(result.skipped))
+
+def run_parallel(names, jobs, verbosity=1):
+    module = sys.modules[__name__]
+    if names:
+        suite = unittest.defaultTestLoader.loadTestsFromNames(names, module)
+    else:
+        suite = unittest.defaultTestLoader.loadTestsFromModule(module)
+    start = time.perf_counter()
+    run = failed = skipped = 0
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(jobs, mp_context=context) as pool:
+        futures = [pool.submit(run_tests, [name], verbosity)
+                   for name in suite_ids(suite)]
+        for future in as_completed(futures):
+            output, tests, failures, skips = future.result()
+            run += tests
+            failed += failures
+            skipped += skips
+            if failures or verbosity > 1:
+                print(output)
+    print('-'*70)
+    print(f'Ran {run} tests in {time.perf_counter() - start:.3f}s with {jobs} jobs')
+    status = f'FAILED (failures={failed})' if failed else 'OK'
+    print(status + (f' (skipped={skipped})' if skipped else ''))
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='brtest',
+        description='Run the regression tests, replaying the recorded tabula fixtures by default')
+    parser.add_argument('tests', nargs='*', help='tests to run, e.g. test_bg.test_multipage_table')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of tests run in parallel (0: one per CPU)')
+    parser.add_argument('--record', help='extract the pages with tabula and record them as fixtures', action='store_true')
+    parser.add_argument('--live', help='extract the pages with tabula, ignoring the fixtures', action='store_true')
+    parser.add_argument('--fixtures', type=str, default=FIXTURES, help='fixture directory (default: fixtures)')
+    parser.add_argument('-v', '--verbose', help='print each test', action='store_true')
+
+    args = parser.parse_args()
+    if args.record and args.live:
+        parser.error('--record and --live are exclusive')
+    if args.record:
+        os.environ['BRTEST_MODE'] = 'record'
+    elif args.live:
+        os.environ['BRTEST_MODE'] = 'live'
+    os.environ['BRTEST_FIXTURES'] = args.fixtures
+    verbosity = 2 if args.verbose else 1
+    jobs = args.jobs or os.cpu_count()
+    if jobs == 1:
+        unittest.main(argv=[sys.argv[0]] + args.tests, verbosity=verbosity)
+    return run_parallel(args.tests, jobs, verbosity)
+
 if __name__ == '__main__':
-    unittest.main()
+    sys.exit(main())
@@ -0,0 +1,328 @@
+#!/home/arnaud/venv/bin/python3
+
+import re
+import json
+from dataclasses import dataclass
+
+PAGE_PROPERTIES = ['axis', 'verbose', 'table_number', 'header_lines',
+                   'header_mask', 'labels', 'move_labels', 'data',
+                   'data_start_column', 'data_in_first_column',
+                   'rebuild_data', 'initial_chapter_name_column',
+                   'chapter_number_mixed_with_name', 'area', 'columns']
+TABLE_PROPERTIES = ['pages'] + PAGE_PROPERTIES
+GENERAL_PROPERTIES = ['filename', 'tables']
+BARE_KEY = re.compile(r'[A-Za-z0-9_-]+')
+
+DEFAULTS = {'axis': 'index',
+            'verbose': False,
+            'table_number': 1,
+            'header_lines': 1,
+            'header_mask': [],
+            'labels': {},
+            'move_labels': [],
+            'data': [],
+            'data_start_column': 2,
+            'data_in_first_column': [],
+            'rebuild_data': False,
+            'initial_chapter_name_column': 1,
+            'chapter_number_mixed_with_name': False,
+            'area': [],
+            'columns': []}
+
+class ConfigError(ValueError):
+    def __init__(self, errors):
+        self.errors = list(errors)
+        super().__init__('\n'.join(self.errors))
+
+@dataclass(frozen=True, slots=True)
+class PageJob:
+    page: int
+    table_number: int
+    header_lines: int
+    header_mask: tuple
+    labels: tuple
+    move_labels: tuple
+    data: tuple
+    data_start_column: int
+    initial_chapter_name_column: int
+    chapter_number_mixed_with_name: bool
+    rebuild_data: bool
+    data_in_first_column: tuple
+    verbose: bool
+    area: tuple
+    columns: tuple
+
+@dataclass(frozen=True, slots=True)
+class TablePlan:
+    name: str
+    pages: object
+    axis: object
+    verbose: bool
+    jobs: tuple
+    layout: object
+
+    @property
+    def single_page(self):
+        return isinstance(self.layout, int)
+
+@dataclass(frozen=True, slots=True)
+class ReportPlan:
+    filename: str
+    tables: tuple
+
+    def table(self, name):
+        for plan in self.tables:
+            if plan.name == name:
+                return plan
+        raise KeyError(name)
+
+def freeze(value):
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def is_pair(value, check=is_int):
+    return (isinstance(value, list) and len(value) == 2
+            and all(check(v) for v in value))
+
+def check_property(where, key, value):
+    if key == 'axis':
+        if value not in [0, 1, 'index', 'columns']:
+            return f"{where}: axis shall be 0, 1, 'index' or 'columns'"
+    elif key in ['verbose', 'rebuild_data', 'chapter_number_mixed_with_name']:
+        if not isinstance(value, bool):
+            return f'{where}: {key} shall be a boolean'
+    elif key in ['table_number', 'header_lines', 'data_start_column',
+                 'initial_chapter_name_column']:
+        if not is_int(value) or value < 0:
+            return f'{where}: {key} shall be a positive integer'
+    elif key == 'header_mask':
+        if not isinstance(value, list) or not all(
+                isinstance(c, list) and len(c) == 2
+                and all(is_pair(x) and min(x) >= 0 for x in c)
+                for c in value):
+            return (f'{where}: header_mask shall be a list of '
+                    '[[row, column], [row, column]] pairs')
+        for c1, c2 in value:
+            if c1[0] > c2[0] or c1[1] > c2[1]:
+                return f'{where}: header_mask {[c1, c2]} is not ordered'
+    elif key == 'labels':
+        if not isinstance(value, dict):
+            return f'{where}: labels shall be a table of column = label'
+        for column, label in value.items():
+            if not str(column).isdigit() or not isinstance(label, str):
+                return f'{where}: labels {column} = {label!r} is invalid'
+    elif key == 'move_labels':
+        if not isinstance(value, list) or not all(is_pair(x) for x in value):
+            return f'{where}: move_labels shall be a list of [source, dest]'
+    elif key == 'data':
+        key_check = lambda x: is_int(x) or isinstance(x, str)
+        if not isinstance(value, list) or not all(
+                isinstance(x, list) and len(x) == 2 and is_pair(x[0], key_check)
+                for x in value):
+            return f'{where}: data shall be a list of [[row, column], value]'
+    elif key == 'area':
+        if value == []:
+            return None
+        if (not isinstance(value, list) or len(value) != 4
+                or not all(is_number(x) and x >= 0 for x in value)):
+            return f'{where}: area shall be [top, left, bottom, right] in points'
+        if value[0] >= value[2] or value[1] >= value[3]:
+            return f'{where}: area {value} is empty'
+    elif key == 'columns':
+        if not isinstance(value, list) or not all(is_number(x) and x >= 0
+                                                  for x in value):
+            return f'{where}: columns shall be a list of x positions in points'
+        if any(x1 >= x2 for x1, x2 in zip(value, value[1:])):
+            return f'{where}: columns {value} are not increasing'
+    elif key == 'data_in_first_column':
+        if not isinstance(value, list) or not all(isinstance(x, str)
+                                                  for x in value):
+            return f'{where}: data_in_first_column shall be a list of labels'
+    return None
+
+def check_pages(pages, top=True):
+    if is_int(pages):
+        return top
+    return (isinstance(pages, list) and len(pages) > 0
+            and all(is_int(p) or check_pages(p, False) for p in pages))
+
+def flatten(pages):
+    if is_int(pages):
+        return [pages]
+    return [p for page in pages for p in flatten(page)]
+
+def make_job(name, page, settings, errors):
+    where = f'[{name}] page {page}'
+    for c1, c2 in settings['header_mask']:
+        if c2[0] >= settings['header_lines']:
+            errors.append(f'{where}: header_mask row {c2[0]} is outside '
+                          f"the {settings['header_lines']} header lines")
+    labels = [(int(column), label)
+              for column, label in settings['labels'].items()]
+    if 0 not in settings['labels'].keys():
+        labels.append((0, 'Chapitre'))
+    initial_chapter_name_column = settings['initial_chapter_name_column']
+    if settings['chapter_number_mixed_with_name']:
+        initial_chapter_name_column = 0
+    return PageJob(page=page,
+                   table_number=settings['table_number'],
+                   header_lines=settings['header_lines'],
+                   header_mask=freeze(settings['header_mask']),
+                   labels=tuple(labels),
+                   move_labels=freeze(settings['move_labels']),
+                   data=tuple((tuple(k), v) for k, v in settings['data']),
+                   data_start_column=settings['data_start_column'],
+                   initial_chapter_name_column=initial_chapter_name_column,
+                   chapter_number_mixed_with_name=settings['chapter_number_mixed_with_name'],
+                   rebuild_data=settings['rebuild_data'],
+                   data_in_first_column=freeze(settings['data_in_first_column']),
+                   verbose=settings['verbose'],
+                   area=freeze(settings['area']),
+                   columns=freeze(settings['columns']))
+
+def compile_table(name, ct):
+    errors = []
+    table = {}
+    overrides = {}
+    for key, value in ct.items():
+        if key in TABLE_PROPERTIES:
+            table[key] = value
+            error = check_property(f'[{name}] {key}', key, value)
+            if error:
+                errors.append(error)
+        elif key.isdigit() and isinstance(value, dict):
+            overrides[int(key)] = value
+            for k, v in value.items():
+                where = f'[{name}] {key}.{k}'
+                if k not in PAGE_PROPERTIES:
+                    errors.append(f'{where}: unknown property')
+                else:
+                    error = check_property(where, k, v)
+                    if error:
+                        errors.append(error)
+        else:
+            errors.append(f'[{name}] {key}: unknown property')
+    pages = table.get('pages')
+    if pages is None:
+        errors.append(f'[{name}] pages is missing')
+    elif not check_pages(pages):
+        errors.append(f'[{name}] pages shall be an integer or a list of '
+                      'integers and lists of integers')
+    else:
+        for page in overrides:
+            if page not in flatten(pages):
+                errors.append(f'[{name}] {page}: page not in pages {pages}')
+    if errors:
+        raise ConfigError(errors)
+
+    jobs = []
+    common = {k: v for k, v in table.items() if k in PAGE_PROPERTIES}
+
+    def resolve(pages, first):
+        settings = dict(DEFAULTS, **common)
+        if not first:
+            settings['table_number'] = 0
+        settings.update(overrides.get(pages, {}))
+        jobs.append(make_job(name, pages, settings, errors))
+        return len(jobs) - 1
+
+    def resolve_list(pages):
+        return tuple(resolve_list(page) if isinstance(page, list)
+                     else resolve(page, i == 0)
+                     for i, page in enumerate(pages))
+
+    if is_int(pages):
+        layout = resolve(pages, True)
+    else:
+        layout = resolve_list(pages)
+    if errors:
+        raise ConfigError(errors)
+    return TablePlan(name=name,
+                     pages=freeze(pages),
+                     axis=table.get('axis', DEFAULTS['axis']),
+                     verbose=table.get('verbose', DEFAULTS['verbose']),
+                     jobs=tuple(jobs),
+                     layout=layout)
+
+def compile_config(conf):
+    errors = []
+    general = conf.get('general')
+    if not isinstance(general, dict):
+        raise ConfigError(['[general] section is missing'])
+    for key in general:
+        if key not in GENERAL_PROPERTIES:
+            errors.append(f'[general] {key}: unknown property')
+    filename = general.get('filename')
+    if not isinstance(filename, str) or not filename:
+        errors.append('[general] filename is missing')
+    tables = general.get('tables')
+    if not isinstance(tables, list) or not all(isinstance(t, str)
+                                                for t in tables):
+        errors.append('[general] tables shall be a list of section names')
+        tables = []
+    plans = []
+    for name in tables:
+        if not isinstance(conf.get(name), dict):
+            errors.append(f'[{name}] section is missing')
+            continue
+        try:
+            plans.append(compile_table(name, conf[name]))
+        except ConfigError as e:
+            errors.extend(e.errors)
+    if errors:
+        raise ConfigError(errors)
+    return ReportPlan(filename=filename, tables=tuple(plans))
+
+def format_toml_key(key):
+    key = str(key)
+    return key if BARE_KEY.fullmatch(key) else json.dumps(key, ensure_ascii=False)
+
+def format_toml_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)
+    if isinstance(value, (list, tuple)):
+        return '[' + ', '.join(format_toml_value(v) for v in value) + ']'
+    if isinstance(value, dict):
+        return '{' + ', '.join(f'{format_toml_key(k)} = {format_toml_value(v)}'
+                               for k, v in value.items()) + '}'
+    raise TypeError(f'{value!r} cannot be written to TOML')
+
+def layout_template(plan, layouts):
+    lines = []
+    for table in plan.tables:
+        lines.append(f'[{format_toml_key(table.name)}]')
+        pages = []
+        for job in table.jobs:
+            if job.page in pages:
+                continue
+            pages.append(job.page)
+            area, columns = layouts[table.name, job.page]
+            prefix = '' if table.single_page else f'{job.page}.'
+            lines.append(f'{prefix}area = {format_toml_value(area)}')
+            lines.append(f'{prefix}columns = {format_toml_value(columns)}')
+        lines.append('')
+    return '\n'.join(lines)
+
+def format_config(conf):
+    lines = []
+    for name, section in conf.items():
+        lines.append(f'[{format_toml_key(name)}]')
+        for key, value in section.items():
+            if str(key).isdigit() and isinstance(value, dict):
+                lines.extend(f'{key}.{format_toml_key(k)} = {format_toml_value(v)}'
+                             for k, v in value.items())
+            else:
+                lines.append(f'{format_toml_key(key)} = {format_toml_value(value)}')
+        lines.append('')
+    return '\n'.join(lines)
@@ -1,85 +1,269 @@
 #!/home/arnaud/venv/bin/python3
 
+import io
+import os
+import json
+import functools
 import re
-import tabula
+import time
+import cProfile
+import contextlib
+import tracemalloc
+import pickle
+import hashlib
+import tempfile
+import traceback
+import dataclasses
 import numpy as np
 import pandas as pd
+import budget_config
+from budget_config import compile_table
+
+PANDAS_OPTIONS = {'header': None, 'dtype': str}
+NUMBER_SPACES = re.compile(r'[ \u00a0\u2009\u202f]')
+DECIMAL_NUMBER = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)')
+AMOUNT = re.compile(r'((\d{1,3} )*\d+,\d\d)')
+AMOUNTS = re.compile(r'((\d{1,3} )*\d+,\d\d)+')
+NOTES = re.compile(r'\(\d+\)')
+CHAPTER_NUMBER = re.compile(r'^(\d+)\s*(.*)', re.S)
+LAYOUT_MARGIN = 2
+LABEL_DTYPES = {'category': 'category', 'arrow': 'string[pyarrow]'}
+
+def file_mode():
+    # mkstemp creates 0600 files, use the mode open() would give
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+class MissingPageError(LookupError):
+    pass
+
+class PageStore:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest, page, options):
+        suffix = hashlib.sha256(options.encode()).hexdigest()[:12]
+        return os.path.join(self.directory, digest, f'{page}-{suffix}.pickle')
+
+    def load(self, digest, page, options):
+        try:
+            with open(self.path(digest, page, options), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def save(self, digest, page, options, tables):
+        path = self.path(digest, page, options)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp, file_mode())
+        os.replace(tmp, path)
+
+class PageCache:
+    def __init__(self, store=None):
+        self.pages = {}
+        self.digests = {}
+        self.registered = {}
+        self.store = store
+        self.offline = False
+
+    def register(self, filename, digest):
+        self.registered[os.path.abspath(filename)] = digest
+
+    def file_id(self, filename):
+        path = os.path.abspath(filename)
+        if path in self.registered:
+            return (path, self.registered[path])
+        st = os.stat(filename)
+        return (path, st.st_mtime_ns, st.st_size)
+
+    def digest(self, filename):
+        path = os.path.abspath(filename)
+        if path in self.registered:
+            return self.registered[path]
+        file_id = self.file_id(filename)
+        if file_id not in self.digests:
+            with open(filename, 'rb') as f:
+                digest = hashlib.file_digest(f, 'sha256').hexdigest()
+            self.digests[file_id] = digest
+        return self.digests[file_id]
+
+    def key(self, filename, page, options):
+        return (self.file_id(filename), page, repr(sorted(options.items())))
+
+    def lookup(self, filename, page, options):
+        key = self.key(filename, page, options)
+        if key not in self.pages and self.store is not None:
+            tables = self.store.load(self.digest(filename), page, key[-1])
+            if tables is not None:
+                self.pages[key] = tables
+        return self.pages.get(key)
+
+    def add(self, filename, page, options, tables):
+        key = self.key(filename, page, options)
+        self.pages[key] = tables
+        if self.store is not None:
+            self.store.save(self.digest(filename), page, key[-1], tables)
+
+    def read(self, filename, page, **options):
+        options = {'stream': True, **options}
+        tables = self.lookup(filename, page, options)
+        if tables is None:
+            self.check_online(filename, page)
+            import tabula
+            tables = tabula.read_pdf(filename,
+                                     pages=page,
+                                     pandas_options=PANDAS_OPTIONS,
+                                     **options)
+            self.add(filename, page, options, tables)
+        return [df.copy() for df in tables]
+
+    def preload(self, filename, pages, **options):
+        options = {'stream': True, **options}
+        missing = [page for page in sorted(set(pages))
+                   if self.lookup(filename, page, options) is None]
+        if missing:
+            self.read_json(filename, missing, options)
+
+    def read_all(self, filename, **options):
+        options = {'stream': True, **options}
+        return self.read_json(filename, 'all', options)
+
+    def read_json(self, filename, pages, options):
+        self.check_online(filename, pages)
+        import tabula
+        tables = tabula.read_pdf(filename, pages=pages,
+                                 output_format='json', **options)
+        raw = {} if pages == 'all' else {page: [] for page in pages}
+        for table in tables:
+            if 'page_number' not in table:
+                # Old tabula-java without page numbers, read pages one by one
+                return {}
+            raw.setdefault(table['page_number'], []).append(table)
+        result = {}
+        for page, page_tables in sorted(raw.items()):
+            tables = tabula.io._extract_from(page_tables, dict(PANDAS_OPTIONS))
+            self.add(filename, page, options, tables)
+            result[page] = tables
+        return result
+
+    def check_online(self, filename, pages):
+        if self.offline:
+            raise MissingPageError(f'{filename}: page {pages} is not in the page store')
+
+    def clear(self):
+        self.pages.clear()
+
+page_cache = PageCache()
+
+class TableReport:
+    def __init__(self, table=None, memory=False, cprofile=(), profile_dir='.'):
+        self.table = table
+        self.memory = memory
+        self.cprofile = list(cprofile)
+        self.profile_dir = profile_dir
+        self.records = []
+
+    def run(self, stage, page, owner, method, *args):
+        rows_before, columns_before = shape(owner.data)
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        profiler = cProfile.Profile() if stage in self.cprofile else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            return method(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self.profile_filename(stage, page))
+            rows, columns = shape(owner.data)
+            record = {'table': self.table, 'page': page, 'stage': stage,
+                      'seconds': seconds,
+                      'rows_before': rows_before,
+                      'columns_before': columns_before,
+                      'rows_after': rows, 'columns_after': columns,
+                      'peak_memory': None}
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                record['peak_memory'] = peak - memory_before
+            self.records.append(record)
+
+    def profile_filename(self, stage, page):
+        name = '-'.join(str(x) for x in [self.table, page, stage]
+                        if x is not None)
+        return os.path.join(self.profile_dir, name + '.prof')
+
+    def seconds(self):
+        totals = {}
+        for record in self.records:
+            stage = record['stage']
+            totals[stage] = totals.get(stage, 0) + record['seconds']
+        return totals
 
 class SinglePageTable:
-    def __init__(self, filename, config, only_read=False):
+    def __init__(self, filename, job, only_read=False, report=None):
         self.data = None
-        self.labels_to_fix = {}
-        self.data_to_fix = {}
-        self.swap_labels_to_column = []
-        self.config = config
-        self.header_lines = 1
-        self.table_number = 1
-        self.pages = None
-        self.data_start_column = 2
-        self.initial_chapter_name_column = 1
-        self.axis = 'index'
-        self.verbose = False
-        self.chapter_number_mixed_with_name = False
-        self.mask_header_cells = []
-        self.rebuild_data = {}
-        self.data_in_first_column = []
-        self.update_config(config)
+        self.report = report
+        self.pages = job.page
+        self.read_options = read_options(job)
+        self.table_number = 0 if self.read_options else job.table_number
+        self.header_lines = job.header_lines
+        self.mask_header_cells = job.header_mask
+        self.labels_to_fix = job.labels
+        self.swap_labels_to_column = job.move_labels
+        self.data_to_fix = dict(job.data)
+        self.data_start_column = job.data_start_column
+        self.initial_chapter_name_column = job.initial_chapter_name_column
+        self.chapter_number_mixed_with_name = job.chapter_number_mixed_with_name
+        self.rebuild_data = job.rebuild_data
+        self.data_in_first_column = list(job.data_in_first_column)
+        self.verbose = job.verbose
         self.read_singlepage_table(filename, self.pages, only_read)
 
-    def update_config(self, config):
-        self.header_lines = config.get('header_lines', self.header_lines)
-        self.data_start_column = config.get('data_start_column',
-                                            self.data_start_column)
-        self.initial_chapter_name_column = config.get('initial_chapter_name_column', self.initial_chapter_name_column)
-        self.data_to_fix = config.get('data', self.data_to_fix)
-        self.labels_to_fix = config.get('labels',
-                                        self.labels_to_fix)
-        if isinstance(self.data_to_fix, list):
-            self.data_to_fix = {(k[0], k[1]): v for k, v in self.data_to_fix}
-        self.swap_labels_to_column = config.get('move_labels',
-                                                self.swap_labels_to_column)
-        self.table_number = config.get('table_number', self.table_number)
-        self.pages = config.get('pages', self.pages)
-        self.axis = config.get('axis', self.axis)
-        self.verbose = config.get('verbose', self.verbose)
-        self.chapter_number_mixed_with_name = config.get('chapter_number_mixed_with_name',self.chapter_number_mixed_with_name)
-        self.mask_header_cells = config.get('header_mask',
-                                            self.mask_header_cells)
-        self.rebuild_data = config.get('rebuild_data', self.rebuild_data)
-        self.data_in_first_column = config.get('data_in_first_column', self.data_in_first_column)
-
     def read_singlepage_table(self, filename, page, only_read):
-        self.update_config(self.config.get(str(page), {}))
-        if self.chapter_number_mixed_with_name:
-            self.initial_chapter_name_column = 0
-        self.read_data(filename, page, self.table_number)
+        self.run_stage(self.read_data, filename, page, self.table_number)
         self.print_if_verbose('*-', f'After read_data Table {self.table_number}')
         if only_read:
             return
 
-        self.convert_header_to_labels()
+        self.run_stage(self.convert_header_to_labels)
         self.print_if_verbose('*/', 'After convert_header_to_labels')
 
-        self.merge_multilines_cells()
+        self.run_stage(self.merge_multilines_cells)
         if self.chapter_number_mixed_with_name:
-            self.extract_chapter_numbers()
+            self.run_stage(self.extract_chapter_numbers)
             self.print_if_verbose('*_', 'After extract_chapter_number')
 
         self.print_if_verbose('*#', 'After merge_multilines_cells')
-        self.remove_notes_from_chapter_names()
-        self.fix_data()
+        self.run_stage(self.remove_notes_from_chapter_names)
+        self.run_stage(self.fix_data)
         self.print_if_verbose('*.', 'After fix_data')
         
-        self.convert_first_col_to_index()
-        self.convert_data()
+        self.run_stage(self.convert_first_col_to_index)
+        self.run_stage(self.convert_data)
         self.print_if_verbose('*+', 'After convert_data')
 
+    def run_stage(self, method, *args):
+        try:
+            if self.report is None:
+                return method(*args)
+            return self.report.run(method.__name__, self.pages, self, method, *args)
+        except Exception as e:
+            mark_stage(e, method.__name__, self.pages)
+            raise
+
     def read_data(self, filename, page, table_number):
-        df = tabula.read_pdf(filename,
-                             pages=page,
-                             stream=True,
-                             pandas_options={'header': None, 'dtype':str},
-                             )
+        df = page_cache.read(filename, page, **self.read_options)
         self.data = df[table_number]
 
     def convert_header_to_labels(self):
@@ -117,32 +301,28 @@ class SinglePageTable:
                 self.data.loc[c1[0]:c2[0],c1[1]:c2[1]] = np.nan
 
     def extract_data_from_first_column(self):
-        data = self.data.iloc[:, 0]
-        data = data.apply(self.split_chapter_and_data)
-        data = data.map(str.strip)
+        cells = self.data.iloc[:, 0]
+        rows = [[value.strip() for value in self.split_chapter_and_data(s)]
+                for s in cells]
         column_names = [self.data.columns[0]]
         column_names.extend(self.data_in_first_column)
-        data.columns = column_names
+        data = pd.DataFrame(rows, index=cells.index, columns=column_names)
         self.data.drop(columns=self.data.columns[0], inplace=True, axis='columns')
         self.data = pd.concat([data, self.data], axis='columns')
 
     def split_chapter_and_data(self, s):
-        elements = re.split(r'((\d{1,3} )*\d+,\d\d)+', s)
-        chapter = elements.pop(0)
-        values = list(filter(lambda x: isinstance(x, str) and ',' in x, elements))
-        res = [chapter]
-        res.extend(values)
-        return pd.Series(res)
-        
+        elements = AMOUNTS.split(s)
+        res = [elements[0]]
+        res.extend(x for x in elements[1:] if isinstance(x, str) and ',' in x)
+        return res
+
     def fix_labels(self, names):
-        if 0 not in self.labels_to_fix.keys():
-            self.labels_to_fix[0] = 'Chapitre'
-        for i, label in self.labels_to_fix.items():
+        for i, label in self.labels_to_fix:
             if label == 'nan':
-                names[int(i)] = np.nan
+                names[i] = np.nan
             else:
-#                names[int(i)] = label.title()
-                names[int(i)] = label
+#                names[i] = label.title()
+                names[i] = label
         return names
 
     def swap_labels_and_column(self, names):
@@ -152,50 +332,55 @@ class SinglePageTable:
         return names
 
     def merge_header_cells(self, cells):
-        return ' '.join(cells[:self.header_lines].dropna().astype(str)).title()
+        return merge_header_cells(cells, self.header_lines)
     
     def merge_multilines_cells(self):
-        drop_list = []
         self.data.dropna(how='all', inplace=True, ignore_index=True)
         self.print_if_verbose('---', 'After dropna')
-        for num, line in self.data.iterrows():
-            if self.is_multirow(num, line):
-                l = self.merge_with_previous_line(num, line)
-                self.data.iloc[num - 1, :] = l
-                drop_list.append(line.name)
-        self.data.drop(drop_list, inplace=True)        
+        multirow = self.multirow_mask()
+        rows = np.flatnonzero(multirow)
+        if rows.size and rows[0] == 0 and multirow.size > 1:
+            # Merging the first row with the "previous" one used to
+            # blank the last row, which then had no data either
+            self.data.iloc[-1, :] = ''
+            multirow[-1] = True
+            rows = np.flatnonzero(multirow)
+        rows = rows[rows > 0]
+        if rows.size:
+            merged = self.merge_lines(self.data.iloc[rows - 1],
+                                      self.data.iloc[rows])
+            self.data.iloc[rows - 1, :] = merged
+        self.data = self.data[~multirow]
         self.data.reset_index(drop=True, inplace=True)
 
-    def is_multirow(self, num, line):
-        if self.has_no_data(line):
-            return True
-        else:
-            if num and self.preceding_row_has_truncated_numbers(num):
-                return True
-
-    def has_no_data(self, line):
-        fun = lambda cell: np.nan if isinstance(cell, str) and not cell else cell
-        a = line.iloc[self.data_start_column:].apply(fun).dropna()
-        return a.empty
-
-    def preceding_row_has_truncated_numbers(self, current_index):
-        preceding_index = current_index - 1
-        fun = lambda cell: isinstance(cell, str) and cell and\
-            ',' not in cell
-        df = self.data.iloc[preceding_index, self.data_start_column:]
-        return df.apply(fun).any()
-    
-    def merge_with_previous_line(self, num, line):
-        fun_a = lambda x: x.apply(self.prepare_for_merge, args=(True,))
-        fun_b = lambda x: x.apply(self.prepare_for_merge, args=(False,))
-        
-        df = self.data.iloc[num - 1:num + 1, :]
-        dfa = df.iloc[:, :self.data_start_column].apply(fun_a)
-        dfb = df.iloc[:, self.data_start_column:].apply(fun_b)
-        sa = dfa.aggregate(' '.join).apply(str.strip)
-        sb = dfb.aggregate(''.join).apply(str.strip)
-        line = pd.concat([sa, sb])
-        return line
+    def multirow_mask(self):
+        no_data = np.ones(self.data.shape[0], dtype=bool)
+        truncated = np.zeros(self.data.shape[0], dtype=bool)
+        for _, cells in self.data.iloc[:, self.data_start_column:].items():
+            cells = cells.astype('string').fillna('')
+            filled = cells.ne('').to_numpy(dtype=bool)
+            comma = cells.str.contains(',', regex=False).to_numpy(dtype=bool)
+            no_data &= ~filled
+            truncated |= filled & ~comma
+        return no_data | np.concatenate([[False], truncated])[:-1]
+
+    def merge_lines(self, first, second):
+        start = self.data_start_column
+        first = self.lines_for_merge(first)
+        second = self.lines_for_merge(second)
+        labels = first[:, :start] + ' ' + second[:, :start]
+        values = first[:, start:] + second[:, start:]
+        merged = np.concatenate([labels, values], axis=1)
+        return np.frompyfunc(str.strip, 1, 1)(merged)
+
+    def lines_for_merge(self, lines):
+        start = self.data_start_column
+        labels = lines.iloc[:, :start].map(self.prepare_for_merge,
+                                           float_to_int=True)
+        values = lines.iloc[:, start:].map(self.prepare_for_merge,
+                                           float_to_int=False)
+        return np.concatenate([labels.to_numpy(dtype=object),
+                               values.to_numpy(dtype=object)], axis=1)
 
     def prepare_for_merge(self, cell, float_to_int):
         if isinstance(cell, float) and np.isnan(cell):
@@ -211,10 +396,7 @@ class SinglePageTable:
         self.data.iloc[:, col] = r
 
     def remove_notes(self, s):
-        if not isinstance(s, str):
-            return s
-        else:
-            return re.sub(r'\(\d+\)', '', s).strip()
+        return remove_notes(s)
 
     def delete_useless_columns(self):
         if np.nan in self.data.columns:
@@ -229,91 +411,73 @@ class SinglePageTable:
             self.rebuild_line_data()
 
     def rebuild_line_data(self):
-        for i, row in self.data.iloc[:, 2:].iterrows():
+        values = self.data.iloc[:, 2:].to_numpy(dtype=object, copy=True)
+        rows = []
+        for i, row in enumerate(values):
             s = self.cleaned_row_as_string(row)
             r = self.split_numbers(s)
             l = self.filter_none_and_integer_values(r)
             if l:
-                self.data.iloc[i, 2:] = l
+                if len(l) == 1:
+                    # iloc used to spread a single amount over the row
+                    l = l * values.shape[1]
+                if len(l) != values.shape[1]:
+                    raise ValueError(f'{len(l)} values found in row {i} '
+                                     f'for {values.shape[1]} columns')
+                values[i] = l
+                rows.append(i)
+        if rows:
+            self.data.iloc[rows, 2:] = values[rows]
         self.print_if_verbose('#', 'After rebuild_line_data')
 
     def cleaned_row_as_string(self, row):
-        return ' '.join(row.dropna())
+        return ' '.join(cell for cell in row if isinstance(cell, str))
 
     def split_numbers(self, s):
-        return re.split(r'((\d{1,3} )*\d+,\d\d)', s)
+        return AMOUNT.split(s)
 
     def filter_none_and_integer_values(self, r):
         return list(filter(lambda x: x is not None and ',' in x, r))
     
     def convert_data(self):
-        def fun(s):
-            if not isinstance(s, str):
-                return s
-            rep = s.replace(' ', '').replace(',', '.')
-            if not s:
-                return np.nan
-            try:
-                return float(rep)
-            except ValueError:
-                return s
-        dataset = self.data.iloc[:, self.data_start_column:]
-        self.data.iloc[:,self.data_start_column:] = dataset.map(fun)
+        for i in range(self.data_start_column, self.data.shape[1]):
+            self.data.isetitem(i, parse_numbers(self.data.iloc[:, i]))
         self.data.dropna(inplace=True, how='all')
         self.data = self.data.convert_dtypes(convert_integer=False)
 
     def convert_first_col_to_index(self):
-        index= pd.Series(["" for x in range(self.data.shape[0])])
-        for i in range(self.data.iloc[:,0].size):
-            value = self.data.iloc[i, 0]
-            if isinstance(value, str) and value:
-                index.iloc[i] = value
-            elif (isinstance(value, str) and not value) or np.isnan(value):
-                index.iloc[i] = self.data.iloc[i, 1]
-                self.data.iloc[i, 1] = ''
-            else:
-                index.iloc[i] = self.to_integer_string(value)
-                
-        index.convert_dtypes()
-        self.data.index = index
+        values = self.data.iloc[:, 0].to_numpy(dtype=object)
+        index = values.copy()
+        strings = string_mask(values)
+        empty = strings & (values == '')
+        numbers = np.flatnonzero(~strings)
+        floats = values[numbers].astype(float)
+        empty[numbers[np.isnan(floats)]] = True
+        known = ~np.isnan(floats)
+        index[numbers[known]] = integer_strings(floats[known])
+        if empty.any():
+            index[empty] = self.data.iloc[:, 1].to_numpy(dtype=object)[empty]
+            self.data.iloc[empty, 1] = ''
+        self.data.index = pd.Series(index, dtype=object)
         self.data.drop('Chapitre', axis=1, inplace=True)
         self.data_start_column = self.data_start_column - 1
 
-    def to_integer_string(self, value):
-        return f'{int(value):d}'
-        
     def extract_chapter_numbers(self):
-        size = self.data.iloc[:, 0].size
-        nums= pd.Series(["" for x in range(size)])
-        names = pd.Series(["" for x in range(size)])
-
-        for i, s in enumerate(self.data.iloc[:,0]):
-            s = self.remove_notes(s)
-            nums[i] = self.find_chapter_number(s)
-            s = self.remove_chapter_number(s)
-            names[i] = self.find_chapter_name(s)
+        values = self.data.iloc[:, 0].to_numpy(dtype=object)
+        nums = values.copy()
+        names = values.copy()
+        strings = string_mask(values)
+        text = pd.Series(values[strings], dtype=object)
+        text = text.str.replace(NOTES, '', regex=True).str.strip()
+        parts = text.str.extract(CHAPTER_NUMBER)
+        numbered = parts[0].notna().to_numpy(dtype=bool)
+        nums[strings] = parts[0].where(numbered, np.nan).to_numpy(dtype=object)
+        names[strings] = parts[1].where(numbered, text).to_numpy(dtype=object)
         self.data.drop(columns=self.data.columns[0], axis=1, inplace=True)
-        df = pd.DataFrame({'Chapitre':nums, 'Libellé':names})
+        df = pd.DataFrame({'Chapitre': pd.Series(nums, dtype=object),
+                           'Libellé': pd.Series(names, dtype=object)})
         self.data = pd.concat([df, self.data], axis=1)
 
-    def find_chapter_number(self, s):
-        if not isinstance(s, str):
-            return s
-        m = re.match(r'^(\d+)', s)
-        if m is None:
-            return np.nan
-        return m.groups()[0]
-
-    def find_chapter_name(self, s):
-        if not isinstance(s, str):
-            return s
-        return s.strip()
-
-    def remove_chapter_number(self, s):
-        if not isinstance(s, str):
-            return s
-        return re.sub(r'^(\d+)', '', s)
-
     def print_if_verbose(self, pattern='', comment=''):
         if self.verbose:
             print(pattern * 20, comment, 'p.', self.pages)
@@ -321,61 +485,270 @@ class SinglePageTable:
             print(self.data.dtypes)
 
 class MultiPageTable:
-    def __init__(self, filename, config, only_read):
+    def __init__(self, filename, plan, only_read, report=None):
         self.data = None
-        self.config = config
-        self.pages = None
-        self.axis = 'index'
-        self.verbose = False
-        self.update_config(self.config)
-        self.read_multipage_table(filename, self.pages, self.axis, only_read)
-
-    def update_config(self, config):
-        self.pages = config.get('pages', self.pages)
-        self.axis = config.get('axis', self.axis)
-        self.verbose = config.get('verbose', self.verbose)
-
-    def read_multipage_table(self, filename, pages, axis, only_read):
-        data = None
-        for page in pages:
-            if data is not None:
-                self.add_to_page_config(page, 'table_number', 0)
-            config = self.config.copy()
-            config['pages'] = page
-            if isinstance(page, list):
-                config['axis'] = 'index'
-                tab = MultiPageTable(filename, config, only_read)
-            else:
-                tab = SinglePageTable(filename, config, only_read)
-            if data is None:
-                data = tab.data
-            else:
-                if axis in [0, 'index']:
-                    data = pd.concat([data, tab.data], axis=axis)
-                else:
-                    data = pd.concat([data, tab.data.iloc[:,1:]],
-                                     axis=axis)
-        self.data = data
+        self.report = report
+        self.plan = plan
+        self.pages = plan.pages
+        self.axis = plan.axis
+        self.verbose = plan.verbose
+        self.read_multipage_table(filename, plan.layout, self.axis, only_read)
+
+    def read_multipage_table(self, filename, layout, axis, only_read):
+        frames = list(self.read_pages(filename, layout, only_read))
+        self.run_stage(self.concat, frames, axis)
         if only_read:
             return
         self.print_if_verbose('/-', 'After concat')
 
-    def add_to_page_config(self, page, key, value):
-        page = str(page)
-        if page not in self.config.keys():
-            self.config[page] = {}
-        self.config[page][key] = self.config[page].get(key, value)
-        
+    def read_pages(self, filename, layout, only_read):
+        for job in layout:
+            if isinstance(job, tuple):
+                frames = list(self.read_pages(filename, job, only_read))
+                yield concat_frames(frames, 'index')
+                continue
+            yield SinglePageTable(filename, self.plan.jobs[job], only_read,
+                                  self.report).data
+
+    def concat(self, frames, axis):
+        self.data = concat_frames(frames, axis)
+
+    def run_stage(self, method, *args):
+        try:
+            if self.report is None:
+                return method(*args)
+            return self.report.run(method.__name__, self.pages, self, method, *args)
+        except Exception as e:
+            mark_stage(e, method.__name__, self.pages)
+            raise
+
     def print_if_verbose(self, pattern='', comment=''):
         if self.verbose:
             print(pattern * 20, comment, 'p.', self.pages)
             print(self.data)
             print(self.data.dtypes)
 
-def read_from_config(filename, ct, only_read=False):
-    pages = ct['pages']
-    if isinstance(pages, int):
-        data = SinglePageTable(filename, ct, only_read).data
+def concat_frames(frames, axis):
+    if len(frames) == 1:
+        return frames[0]
+    if axis not in [0, 'index']:
+        frames = frames[:1] + [data.iloc[:, 1:] for data in frames[1:]]
+    return pd.concat(frames, axis=axis)
+
+def merge_header_cells(cells, header_lines):
+    return ' '.join(cells[:header_lines].dropna().astype(str)).title()
+
+def remove_notes(s):
+    if not isinstance(s, str):
+        return s
     else:
-        data = MultiPageTable(filename, ct, only_read).data
+        return NOTES.sub('', s).strip()
+
+def header_signature(data, header_lines):
+    return [remove_notes(merge_header_cells(col, header_lines))
+            for _, col in data.items()]
+
+def mark_stage(error, stage, page):
+    if getattr(error, 'stage', None) is None:
+        error.stage = stage
+        error.page = page
+
+def failure_record(table, error):
+    return {'table': table,
+            'stage': getattr(error, 'stage', None),
+            'page': getattr(error, 'page', None),
+            'error': f'{type(error).__name__}: {error}',
+            'traceback': ''.join(traceback.format_exception(error))}
+
+def shape(data):
+    return (0, 0) if data is None else data.shape
+
+def string_mask(values):
+    if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+        return pd.notna(values)
+    return np.array([isinstance(v, str) for v in values], dtype=bool)
+
+def integer_strings(values):
+    return np.trunc(values).astype('int64').astype(str).astype(object)
+
+def parse_numbers(cells):
+    values = cells.to_numpy(dtype=object, copy=True)
+    strings = string_mask(values)
+    text = pd.Series(values[strings], dtype=object)
+    cleaned = text.str.replace(NUMBER_SPACES, '', regex=True)
+    cleaned = cleaned.str.replace(',', '.', regex=False)
+    parsed = text.to_numpy(dtype=object, copy=True)
+    number = cleaned.str.fullmatch(DECIMAL_NUMBER).to_numpy(dtype=bool)
+    parsed[number] = cleaned[number].to_numpy(dtype=object).astype(float)
+    empty = text.eq('').to_numpy(dtype=bool)
+    parsed[empty] = np.nan
+    for i in np.flatnonzero(~number & ~empty):
+        try:
+            parsed[i] = float(cleaned.iloc[i])
+        except ValueError:
+            pass
+    values[strings] = parsed
+    return pd.Series(values, index=cells.index, name=cells.name)
+
+def to_centimes(cells):
+    values = cells.to_numpy(dtype='float64', na_value=np.nan)
+    known = ~np.isnan(values)
+    centimes = np.round(values[known] * 100)
+    exact = ((centimes / 100 == values[known]).all()
+             and (np.signbit(values[known]) == (centimes < 0)).all()
+             and (np.abs(centimes) < 2**53).all())
+    if not exact:
+        return None
+    result = pd.array(np.zeros(len(values), dtype='int64'), dtype='Int64')
+    result[known] = centimes.astype('int64')
+    result[~known] = pd.NA
+    return pd.Series(result, index=cells.index, name=cells.name)
+
+def lean_dtypes(data, amounts=None, labels=None):
+    data = data.copy()
+    centimes = []
+    for i, (name, cells) in enumerate(list(data.items())):
+        if pd.api.types.is_float_dtype(cells.dtype):
+            converted = to_centimes(cells) if amounts == 'centimes' else None
+            if converted is not None:
+                data.isetitem(i, converted)
+                centimes.append(i)
+            elif amounts is not None:
+                data.isetitem(i, cells.astype('float64'))
+        elif labels and isinstance(cells.dtype, pd.StringDtype):
+            data.isetitem(i, cells.astype(LABEL_DTYPES[labels]))
+    if labels:
+        data.index = data.index.astype(LABEL_DTYPES[labels])
+    if amounts == 'centimes':
+        data.attrs['centimes'] = centimes
     return data
+
+def format_centimes(data):
+    centimes = data.attrs.get('centimes', [])
+    if not centimes:
+        return data
+    data = data.copy()
+    for i in centimes:
+        cells = data.iloc[:, i]
+        known = cells.notna().to_numpy()
+        values = cells.to_numpy(dtype='int64', na_value=0)
+        units, cents = np.divmod(np.abs(values), 100)
+        text = (pd.Series(np.where(values < 0, '-', ''), dtype=object)
+                + pd.Series(units).astype(str) + '.'
+                + pd.Series(cents).astype(str).str.zfill(2))
+        text = np.where(known, text.to_numpy(dtype=object), np.nan)
+        data.isetitem(i, pd.Series(text, index=data.index, name=cells.name))
+    return data
+
+def read_options(job):
+    options = {}
+    if job.area:
+        options['area'] = list(job.area)
+    if job.columns:
+        options['columns'] = list(job.columns)
+    if options:
+        options['guess'] = False
+    return options
+
+def preload_plans(filename, plans):
+    groups = {}
+    for plan in plans:
+        for job in plan.jobs:
+            options = read_options(job)
+            key = repr(sorted(options.items()))
+            groups.setdefault(key, (options, set()))[1].add(job.page)
+    for options, pages in groups.values():
+        try:
+            page_cache.preload(filename, pages, **options)
+        except Exception as e:
+            mark_stage(e, 'preload', sorted(pages))
+            raise
+
+def table_layout(table, margin=LAYOUT_MARGIN):
+    top, left = table['top'], table['left']
+    area = [top - margin, left - margin,
+            top + table['height'] + margin, left + table['width'] + margin]
+    rows = [row for row in table['data'] if row]
+    columns = []
+    for k in range(1, max((len(row) for row in rows), default=0)):
+        rights = [c['left'] + c['width'] for row in rows if len(row) > k
+                  for c in row[k - 1:k] if c['text']]
+        lefts = [c['left'] for row in rows if len(row) > k
+                 for c in row[k:k + 1] if c['text']]
+        if rights and lefts:
+            columns.append((max(rights) + min(lefts)) / 2)
+        elif lefts:
+            columns.append(min(lefts) - margin)
+    area = [round(max(x, 0), 1) for x in area]
+    return area, sorted({round(x, 1) for x in columns})
+
+def detect_layouts(filename, plans):
+    import tabula
+
+    pages = sorted({job.page for plan in plans for job in plan.jobs})
+    tables = tabula.read_pdf(filename, pages=pages, stream=True,
+                             output_format='json')
+    if not all('page_number' in table for table in tables):
+        tables = [dict(table, page_number=page) for page in pages
+                  for table in tabula.read_pdf(filename, pages=page, stream=True,
+                                               output_format='json')]
+    detected = {page: [] for page in pages}
+    for table in tables:
+        detected[table['page_number']].append(table)
+    layouts = {}
+    for plan in plans:
+        for job in plan.jobs:
+            layouts[plan.name, job.page] = table_layout(
+                detected[job.page][job.table_number])
+    return layouts
+
+def read_table(filename, plan, only_read=False, report=None, dtypes=None):
+    if plan.single_page:
+        data = SinglePageTable(filename, plan.jobs[plan.layout], only_read,
+                               report).data
+    else:
+        data = MultiPageTable(filename, plan, only_read, report).data
+    if dtypes and not only_read:
+        data = lean_dtypes(data, **dtypes)
+    return data
+
+def read_from_config(filename, ct, only_read=False, report=None):
+    name = 'table' if report is None or report.table is None else report.table
+    return read_table(filename, compile_table(name, ct), only_read, report)
+
+@functools.cache
+def code_version():
+    digest = hashlib.sha256()
+    for module in [__file__, budget_config.__file__]:
+        with open(module, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def table_fingerprint(filename, plan, only_read=False, dtypes=None):
+    content = json.dumps({'plan': dataclasses.asdict(plan),
+                          'pdf': page_cache.digest(filename),
+                          'code': code_version(),
+                          'only_read': only_read,
+                          'dtypes': dtypes},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+def use_store(directory):
+    page_cache.store = PageStore(directory) if directory else None
+
+def convert_table(filename, plan, only_read=False, report=None, dtypes=None,
+                  cache_dir=None):
+    store = page_cache.store
+    if (store.directory if store else None) != cache_dir:
+        # The worker moved on to another report
+        use_store(cache_dir)
+        page_cache.clear()
+    output = io.StringIO()
+    data = failure = None
+    with contextlib.redirect_stdout(output):
+        try:
+            preload_plans(filename, [plan])
+            data = read_table(filename, plan, only_read, report, dtypes)
+        except Exception as e:
+            failure = failure_record(plan.name, e)
+    return plan.name, data, report, output.getvalue(), failure
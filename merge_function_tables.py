@@ -1,40 +1,90 @@
 #!/home/arnaud/venv/bin/python3
 
 import os
+import argparse
 import numpy as np
 import pandas as pd
 
+SECTIONS = ['i', 'f']
+FUNCTIONS = range(9)
+
 def convert_data(data, show=False):
-    for i, v in enumerate(data.iloc[:,0]):
-        if not isinstance(v, str) and \
-           (isinstance(v, pd._libs.missing.NAType) or np.isnan(v)):
-            data.iloc[i, 0] = ''
+    data.isetitem(0, data.iloc[:, 0].fillna(''))
     return data.convert_dtypes(convert_integer=False)
 
-def merge_dataframes(df1, df2):
-    df = df1.copy(deep=True)
-    for i, row in df2.iterrows():
-        idx = row.name
-        df.loc[idx, row.index] = row
-    return df
-
-expense = pd.DataFrame()
-income = pd.DataFrame()
-in_expense = False
-for j in ['i', 'f']:
-    for i in range(9):
-        filename = f'f{i}{j}.csv'
-        if not os.path.isfile(filename):
-            continue
-        df1 = convert_data(pd.read_csv(filename, index_col=0))
-        income_start = df1.index.to_list().index('RECETTES')
-        expense = merge_dataframes(expense, df1.iloc[1:income_start, :])
-        income = merge_dataframes(income, df1.iloc[income_start + 1:, :])
-    print(expense)
-    print(expense.columns)
-    print(expense.dtypes)
-    print(income)
-    print(income.columns)
-    print(income.dtypes)
-    expense.map(lambda x: np.nan if isinstance(x, bytes) and not x else x).to_csv(f'DEPENSES-{j}.csv', float_format='%.2f')
-    income.map(lambda x: np.nan if isinstance(x, bytes) and not x else x).to_csv(f'RECETTES-{j}.csv', float_format='%.2f')
+def split_expense_income(data):
+    income_start = data.index.to_list().index('RECETTES')
+    return data.iloc[1:income_start, :], data.iloc[income_start + 1:, :]
+
+def merge_dataframes(frames):
+    frames = [df for df in frames if len(df)]
+    if not frames:
+        return pd.DataFrame()
+    labels = pd.Index(pd.concat([df.index.to_series() for df in frames]))
+    index = labels.unique()
+    columns = pd.Index([c for df in frames for c in df.columns]).unique()
+    rows = index.get_indexer(labels)
+    new_rows = ~labels.duplicated()
+    starts = np.cumsum([0] + [len(df) for df in frames])
+    values = np.full((len(index), len(columns)), np.nan, dtype=object)
+    for i, column in enumerate(columns):
+        events = np.concatenate([np.arange(start, start + len(df))
+                                 for start, df in zip(starts, frames)
+                                 if column in df.columns])
+        cells = np.concatenate([df[column].to_numpy(dtype=object)
+                                for df in frames if column in df.columns])
+        last = ~pd.Series(rows[events]).duplicated(keep='last').to_numpy()
+        cells[last] = merged_cells(cells, events, new_rows[events[0]])[last]
+        values[rows[events[last]], i] = cells[last]
+    return pd.DataFrame(values, index=index, columns=columns).infer_objects()
+
+def merged_cells(cells, events, new_row):
+    # The row by row .loc assignment stored pd.NA as NaN as long as the
+    # column was still float64, which decides the CSV float format
+    strings = np.flatnonzero([isinstance(v, str) for v in cells])
+    if new_row or not isinstance(cells[0], float):
+        float_until = events[0]
+    elif strings.size:
+        float_until = events[strings[0]]
+    else:
+        float_until = events[-1] + 1
+    na = np.array([v is pd.NA for v in cells], dtype=bool) & (events < float_until)
+    cells = cells.copy()
+    cells[na] = np.nan
+    return cells
+
+def merge_function_tables(input_dir='.', output_dir='.', verbose=False):
+    expenses = []
+    incomes = []
+    for j in SECTIONS:
+        for i in FUNCTIONS:
+            filename = os.path.join(input_dir, f'f{i}{j}.csv')
+            if not os.path.isfile(filename):
+                continue
+            data = convert_data(pd.read_csv(filename, index_col=0))
+            expense, income = split_expense_income(data)
+            expenses.append(expense)
+            incomes.append(income)
+        expense = merge_dataframes(expenses)
+        income = merge_dataframes(incomes)
+        if verbose:
+            print(expense)
+            print(expense.dtypes)
+            print(income)
+            print(income.dtypes)
+        expense.to_csv(os.path.join(output_dir, f'DEPENSES-{j}.csv'), float_format='%.2f')
+        income.to_csv(os.path.join(output_dir, f'RECETTES-{j}.csv'), float_format='%.2f')
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='merge_function_tables',
+        description='Merge the f<function><section>.csv tables into DEPENSES and RECETTES tables')
+    parser.add_argument('-i', '--input-dir', type=str, default='.', help='directory of the f*.csv tables')
+    parser.add_argument('-o', '--output-dir', type=str, default='.', help='output directory')
+    parser.add_argument('-v', '--verbose', help='print the merged tables', action='store_true')
+
+    args = parser.parse_args()
+    merge_function_tables(args.input_dir, args.output_dir, args.verbose)
+
+if __name__ == '__main__':
+    main()